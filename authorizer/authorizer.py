@@ -1,6 +1,8 @@
 import os, logging
 import requests
 
+import jsoncodec
+
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
@@ -32,8 +34,7 @@ def handler(event, _ctx):
         headers = {"Authorization": f"Bearer {token}"}
 
         response = requests.post(profile_url, headers=headers)
-        print(response.json())
-        data = response.json()
+        data = jsoncodec.loads(response.content)
 
         # Check if the response status is success
         if data.get("status") == "success" and "details" in data:
@@ -0,0 +1,54 @@
+"""
+Synthetic corpus of log records for the benchmarks, shaped like what the
+producers put on the stream (see scripts/push-logs.sh).
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+MESSAGES = [
+    "runtime warn: OOM risk detected in container 8b3f",
+    "runtime error: connection timeout after 30s retry",
+    "runtime info: scaling up resources to 4 vCPUs",
+    "runtime info: health check passed with 23ms latency",
+    "runtime info: model loaded successfully in 1.2s",
+    "runtime error: CUDA out of memory in batch processor",
+    "runtime warn: GPU throttling detected at 82°C",
+    "runtime info: batch processing completed for 128 images",
+    "Step 4/12 : RUN pip install -r requirements.txt",
+    "Collecting torch==2.3.0 (from -r requirements.txt (line 1))",
+    'Traceback (most recent call last):\n  File "app.py", line 12, in infer',
+    'INFO:     127.0.0.1:51234 - "POST /v2/models/infer HTTP/1.1" 200 OK',
+]
+
+
+def records(count=10000, identifiers=4, seed=7):
+    """Raw producer records, as decoded from Kinesis."""
+    rng = random.Random(seed)
+    ids = ["%032x" % rng.getrandbits(128) for _ in range(identifiers)]
+    start = datetime(2025, 5, 1, tzinfo=timezone.utc)
+    out = []
+    for i in range(count):
+        identifier = rng.choice(ids)
+        at = start + timedelta(milliseconds=i * rng.randint(1, 40))
+        out.append(
+            {
+                "log": f"{identifier} - {rng.choice(MESSAGES)}",
+                "stream": rng.choice(("stdout", "stdout", "stdout", "stderr")),
+                "time": at.isoformat(timespec="microseconds").replace("+00:00", "Z"),
+                "identifierId": identifier,
+                "modelId": "mdl-999",
+                "logType": "runtimeLogs",
+            }
+        )
+    return out
+
+
+def items(count=10000, identifiers=4, seed=7):
+    """Records as the consumer pushes them, after identifier stripping."""
+    out = []
+    for record in records(count, identifiers, seed):
+        item = dict(record)
+        item["log"] = item["log"].split(" - ", 1)[1]
+        out.append(item)
+    return out
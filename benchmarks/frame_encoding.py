@@ -0,0 +1,62 @@
+"""
+Encode throughput of JSON and MessagePack frames, row and columnar.
+
+    python benchmarks/frame_encoding.py
+"""
+
+import os
+import sys
+import timeit
+
+for path in ("consumer", "shared"):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", path))
+
+from corpus import items  # noqa: E402
+from frames import msgpack, pack_frames  # noqa: E402
+import jsoncodec  # noqa: E402
+
+
+def main():
+    corpus = [(item, None) for item in items(10000)]
+    encodings = [None] + (["msgpack"] if msgpack is not None else [])
+    if msgpack is None:
+        print("msgpack not installed, only measuring JSON")
+
+    # Serializer alone, on 100-line batches
+    batches = [
+        [item for item, _ in corpus[start : start + 100]]
+        for start in range(0, len(corpus), 100)
+    ]
+    serializers = {"json": jsoncodec.dumps}
+    if msgpack is not None:
+        serializers["msgpack"] = msgpack.packb
+    print("%10s %14s" % ("serializer", "lines/s"))
+    for name, dumps in serializers.items():
+        seconds = timeit.timeit(lambda: [dumps(b) for b in batches], number=5)
+        print("%10s %14.0f" % (name, len(corpus) * 5 / seconds))
+    print()
+
+    # Whole packer: sizing, truncation checks, shaping and serializing
+    print("%10s %10s %14s %12s" % ("format", "encoding", "lines/s", "MB/s"))
+    for fmt in (None, "columnar"):
+        for encoding in encodings:
+            frames = list(pack_frames(corpus, fmt=fmt, encoding=encoding))
+            size = sum(len(frame) for frame, _ in frames)
+            runs = 5
+            seconds = timeit.timeit(
+                lambda: list(pack_frames(corpus, fmt=fmt, encoding=encoding)),
+                number=runs,
+            )
+            print(
+                "%10s %10s %14.0f %12.1f"
+                % (
+                    fmt or "row",
+                    encoding or "json",
+                    len(corpus) * runs / seconds,
+                    size * runs / seconds / 1e6,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Decode and encode throughput of the shared JSON codec, with the standard
+library and with orjson (when installed).
+
+    python benchmarks/json_codec.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+for path in ("consumer", "shared"):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", path))
+
+from corpus import items, records  # noqa: E402
+from jsoncodec import orjson  # noqa: E402
+
+
+def main():
+    raw = [json.dumps(record).encode() for record in records(10000)]
+    corpus = items(10000)
+    batches = [corpus[start : start + 100] for start in range(0, len(corpus), 100)]
+
+    backends = {
+        "json": (
+            json.loads,
+            lambda value: json.dumps(
+                value, separators=(",", ":"), ensure_ascii=False
+            ).encode(),
+        )
+    }
+    if orjson is not None:
+        backends["orjson"] = (orjson.loads, orjson.dumps)
+    else:
+        print("orjson not installed, only measuring the standard library")
+
+    print("%8s %16s %16s" % ("backend", "loads lines/s", "dumps lines/s"))
+    for name, (loads, dumps) in backends.items():
+        decode = timeit.timeit(lambda: [loads(r) for r in raw], number=5)
+        encode = timeit.timeit(lambda: [dumps(b) for b in batches], number=5)
+        print(
+            "%8s %16.0f %16.0f"
+            % (name, len(raw) * 5 / decode, len(corpus) * 5 / encode)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+extract_log_item as it was before consumer/normalize.py replaced it. It gave
+the outputs of golden/normalize.jsonl and is the baseline of normalizer.py.
+"""
+
+import json
+import logging
+import re
+
+log = logging.getLogger()
+
+
+log_filter_string = [
+    "By pulling and using the container, you accept the terms and conditions of this license:"
+]
+
+
+def extract_log_item(log_item, type="BUILD", ignore=False):
+    try:
+        # Make a copy of the entire log item to preserve all fields
+        temp_log_data = log_item.copy() if isinstance(log_item, dict) else {}
+
+        if isinstance(log_item, str):
+            temp = json.loads(log_item)
+        elif isinstance(log_item, dict):
+            temp = log_item
+
+        # Debug input
+        log.info("Processing log item: %s", json.dumps(temp)[:200])
+
+        # Ensure time field exists
+        if "time" in temp:
+            temp_log_data["time"] = temp["time"]
+        elif "@timestamp" in temp:
+            temp_log_data["time"] = temp["@timestamp"]
+        else:
+            # Default time if missing
+            temp_log_data["time"] = "unknown"
+
+        # Get the log content, with fallback
+        log_content = temp.get("log", "")
+        if not log_content and "message" in temp:
+            log_content = temp.get("message", "")
+
+        log.info("Original log content: %s", log_content[:100])
+
+        # Ensure stream field
+        if "stream" in temp:
+            temp_log_data["stream"] = temp["stream"]
+        else:
+            temp_log_data["stream"] = "stdout"
+
+        # Preserve identifierId if present
+        if "identifierId" in temp:
+            temp_log_data["identifierId"] = temp["identifierId"]
+
+        # Process the log content
+        if type == "INFERENCE":
+            temp_log_data["log"] = re.sub(r"^I.*?\]", "", log_content)
+        elif type == "BUILD":
+            temp_log_data["log"] = re.sub(r"^\[.*?\]", "", log_content)
+            temp_log_data["log"] = re.sub(r"^I.*?\]", "", temp_log_data["log"])
+        else:
+            temp_log_data["log"] = log_content
+
+        # Trim any leading/trailing whitespace after timestamp removal
+        if "log" in temp_log_data:
+            temp_log_data["log"] = temp_log_data["log"].strip()
+
+        if not ignore:
+            pattern = re.compile(r"(?i)(nvidia|triton)")
+            if re.search(pattern, temp_log_data["log"]):
+                temp_log_data["log"] = ""
+
+        # Check for specific filter strings
+        if log_content in log_filter_string:
+            temp_log_data["log"] = ""
+
+        # Special identifier removal - handle this first and directly
+        log.info(
+            "Before identifier removal: %s",
+            temp_log_data["log"][:100] if "log" in temp_log_data else "No log content",
+        )
+
+        # Get exact pattern from the log line
+        if "identifierId" in temp:
+            identifier = temp["identifierId"]
+            if isinstance(identifier, list) and identifier:
+                identifier = identifier[0]
+            elif not isinstance(identifier, str):
+                identifier = None
+        else:
+            identifier = None
+
+        # Extract any hex identifier that might be at the start
+        if "log" in temp_log_data and temp_log_data["log"]:
+            # Try the exact pattern with the known identifier first
+            if identifier:
+                log.info("Using identifier: %s", identifier)
+
+                # Direct string replacement - for exact match at start of string after trimming
+                if temp_log_data["log"].startswith(identifier):
+                    # Check if followed by " - "
+                    rest = temp_log_data["log"][len(identifier) :].lstrip()
+                    if rest.startswith("- "):
+                        temp_log_data["log"] = rest[
+                            2:
+                        ].strip()  # Remove "- " and any whitespace
+                        log.info("Removed identifier using exact start match")
+
+                # Pattern for identifier anywhere in the string with possible whitespace
+                pattern = r"(?:\s|^)" + re.escape(identifier) + r"\s*-\s*"
+                before = temp_log_data["log"]
+                temp_log_data["log"] = re.sub(
+                    pattern,
+                    " ",
+                    temp_log_data["log"],
+                    count=1,  # Add count=1 to prevent multiple replacements
+                ).strip()
+                if before != temp_log_data["log"]:
+                    log.info("Removed with flexible pattern")
+
+            # Generic pattern for any hex ID of any length
+            pattern = r"(?:\s|^)([a-f0-9]{32})\s*-\s*"
+            before = temp_log_data["log"]
+            temp_log_data["log"] = re.sub(
+                pattern, " ", temp_log_data["log"], count=1
+            ).strip()
+            if before != temp_log_data["log"]:
+                log.info("Removed with generic hex pattern")
+
+            # Extra pattern specifically for your log format from the example
+            specific_pattern = r"([a-f0-9]{32})\s*-\s*"
+            before = temp_log_data["log"]
+            temp_log_data["log"] = re.sub(
+                specific_pattern, "", temp_log_data["log"], count=1
+            ).strip()
+            if before != temp_log_data["log"]:
+                log.info("Removed with specific pattern match")
+
+            # If all else fails, try a brutal force approach for this specific identifier
+            if identifier and identifier in temp_log_data["log"]:
+                parts = temp_log_data["log"].split(identifier + " - ", 1)
+                if len(parts) > 1:
+                    temp_log_data["log"] = parts[1].strip()
+                    log.info("Removed using string split")
+
+            # Final cleanup to ensure any remaining dash at beginning is removed
+            temp_log_data["log"] = re.sub(
+                r"^[\s-]+", "", temp_log_data["log"], count=1
+            ).strip()
+
+            # Extreme fallback - if we still have a dash at the beginning, remove it
+            if temp_log_data["log"].startswith("-"):
+                temp_log_data["log"] = temp_log_data["log"][1:].strip()
+                log.info("Removed leading dash with fallback")
+
+            # Check for specific pattern: dash followed by whitespace at beginning
+            if temp_log_data["log"].startswith("- "):
+                temp_log_data["log"] = temp_log_data["log"][2:].strip()
+                log.info("Removed '- ' prefix")
+
+        log.info(
+            "Final extracted log: %s",
+            temp_log_data["log"][:100] if "log" in temp_log_data else "No log content",
+        )
+        return temp_log_data
+
+    except Exception as e:
+        log.error("Error in extract_log_item: %s", str(e))
+        return log_item
@@ -0,0 +1,69 @@
+"""
+Check the log normalizer against the golden corpus, then compare its
+throughput with the extract_log_item it replaced.
+
+    python benchmarks/normalizer.py
+
+The golden corpus (golden/normalize.jsonl) holds inputs and the output the
+old implementation gave for them; outputs must match byte for byte.
+"""
+
+import json
+import logging
+import os
+import sys
+import timeit
+
+for path in ("consumer", "shared"):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", path))
+
+from corpus import records  # noqa: E402
+from legacy_normalize import extract_log_item  # noqa: E402
+from normalize import LOG_TYPES, normalize, normalize_record  # noqa: E402
+
+GOLDEN = os.path.join(os.path.dirname(__file__), "golden", "normalize.jsonl")
+
+
+def check_golden():
+    mismatches = 0
+    with open(GOLDEN, encoding="utf-8") as lines:
+        for number, line in enumerate(lines, 1):
+            case = json.loads(line)
+            got = normalize(case["input"], case["type"], case["ignore"])
+            if json.dumps(got) != json.dumps(case["output"]):
+                mismatches += 1
+                print("golden line %d: %r != %r" % (number, got, case["output"]))
+    return number, mismatches
+
+
+def main():
+    # Both implementations log at INFO (the old one on every line), as they
+    # would in the Lambda
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger().addHandler(logging.StreamHandler(open(os.devnull, "w")))
+
+    cases, mismatches = check_golden()
+    print("golden corpus: %d cases, %d mismatches" % (cases, mismatches))
+    if mismatches:
+        sys.exit(1)
+
+    corpus = records(10000)
+    print("%18s %14s" % ("normalizer", "lines/s"))
+    for name, function in (
+        ("extract_log_item", extract_log_item),
+        ("normalize", normalize),
+    ):
+        seconds = timeit.timeit(lambda: [function(r) for r in corpus], number=3)
+        print("%18s %14.0f" % (name, len(corpus) * 3 / seconds))
+    print()
+
+    # Dispatch by logType to the specialized normalizers
+    print("%18s %14s" % ("logType", "lines/s"))
+    for log_type in LOG_TYPES:
+        typed = [{**r, "logType": log_type} for r in corpus]
+        seconds = timeit.timeit(lambda: [normalize_record(r) for r in typed], number=3)
+        print("%18s %14.0f" % (log_type, len(corpus) * 3 / seconds))
+
+
+if __name__ == "__main__":
+    main()
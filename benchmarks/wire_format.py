@@ -0,0 +1,37 @@
+"""
+Byte size of the row (JSON array) and columnar frame formats.
+
+    python benchmarks/wire_format.py
+"""
+
+import gzip
+import json
+import os
+import sys
+
+for path in ("consumer", "shared"):
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", path))
+
+from corpus import items  # noqa: E402
+from frames import to_columnar  # noqa: E402
+
+
+def main():
+    corpus = items(10000)
+    print("%8s %14s %14s %14s %14s" % ("lines", "row", "columnar", "row+gz", "col+gz"))
+    for lines in (1, 10, 100, 1000):
+        sizes = [0, 0, 0, 0]
+        for start in range(0, len(corpus), lines):
+            batch = corpus[start : start + lines]
+            row = json.dumps(batch).encode()
+            col = json.dumps(to_columnar(batch)).encode()
+            for i, frame in enumerate(
+                (row, col, gzip.compress(row), gzip.compress(col))
+            ):
+                sizes[i] += len(frame)
+        per_line = ["%.1f B/line" % (size / len(corpus)) for size in sizes]
+        print("%8d %14s %14s %14s %14s" % (lines, *per_line))
+
+
+if __name__ == "__main__":
+    main()
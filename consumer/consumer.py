@@ -1,63 +1,143 @@
-import re
 import boto3
-import json
 import os
 import base64
 import logging
-from time import sleep
+from collections import OrderedDict
+from functools import partial
+from time import monotonic, sleep
+
+from botocore.config import Config
+
+import jsoncodec
+import metrics
+import rules
+from decode import END_OF_RECORD, SUB_BITS, decode_records, handle_position, position
+from dedup import ContentDeduplicator
+from filters import compile_filter
+from frames import encode_frame, encode_message, pack_frames
+from normalize import normalize_record, take_stats
+from ratelimit import TokenBucket
+from sender import LANES, LATENCY, SEND_URGENT_WINDOW, Sender
+from subscriptions import Subscriptions, route_keys, route_values
 
 # AWS clients
 ddb = boto3.client("dynamodb")
 kinesis = boto3.client("kinesis")
+lambdacli = boto3.client("lambda")
+# Throttled sends are retried by the send layer, within the deadline
 mgmt = boto3.client(
-    "apigatewaymanagementapi", endpoint_url=os.environ["WS_CALLBACK_URL"]
+    "apigatewaymanagementapi",
+    endpoint_url=os.environ["WS_CALLBACK_URL"],
+    config=Config(retries={"mode": "standard", "max_attempts": 1}),
 )
 
 # Configuration
 STREAM = os.environ["STREAM"]
 TABLE = os.environ["TABLE"]
-GSI = "identifier-index"
+
+# Stop taking on work once the invocation has less time left than this
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", 10000))
+
+# Time the real-time fan-out of one batch may take, 0 for up to the deadline.
+# Lines not sent within it are failed and retried with the next attempt.
+BATCH_BUDGET_MS = int(os.environ.get("BATCH_BUDGET_MS", 0))
 
 # In-memory subscription map: connectionId -> identifierId list
 IDENTIFIER_FILTER: dict[str, list[str]] = {}
 
+# Connections subscribed to identifiers, to identifier prefixes
+# ("runtime-*"), matched against every identifier of a batch, and to routes
+# (modelId and logType, see subscriptions.ROUTE_DIMENSIONS), as last read
+# from the table
+SUBSCRIPTIONS = Subscriptions()
+
+# Negative cache of connections found gone: connectionId -> monotonic time.
+# Their rows can linger in the table (and the subscriber lists) for a while.
+GONE_CONNECTIONS: dict[str, float] = {}
+GONE_TTL_SECONDS = int(os.environ.get("GONE_TTL_SECONDS", 3600))
+
+# Delivery high-water marks: connectionId -> lane -> shardId -> highest
+# position (sequence and sub-sequence number, see decode.position) sent.
+# Records at or below the mark of their lane were already delivered (by the
+# back-fill or an earlier attempt of the same batch) and are skipped. Marks
+# are kept per lane as urgent lines may be sent ahead of the others (see
+# _process_kinesis).
+#
+# Back-fills and retried batches often run in another container, so the
+# marks (and LIVE_STARTS below) are also saved on the connection row
+# ("deliveryMarks") after each batch and back-fill page that sent lines.
+# They are merged in by every back-fill invocation, and by a batch when its
+# container has no marks of the connection yet. A container that already has
+# some keeps its own until they expire (see CONNECTION_STATE_TTL_SECONDS).
+WATERMARKS: dict[str, dict[str, dict[str, int]]] = {}
+
+# Where the real-time fan-out started delivering to each connection:
+# connectionId -> shardId -> lowest position it sent. A back-fill goes by its
+# own checkpoint, and only skips as already delivered the records at or
+# above this position, so that real-time batches handled between two of its
+# invocations do not hide history it has yet to send.
+LIVE_STARTS: dict[str, dict[str, int]] = {}
+
+# Levels of the lines sent in the urgent lane (see sender.LANES), along with
+# stderr lines. They are also the last dropped when a connection is over its
+# line budget.
+URGENT_LEVELS = ("error", "fatal")
+
+# Per-connection line budget of the real-time fan-out, unless the connection
+# set a lower one in streamLogs (see registrar). Lines over the budget are
+# dropped and reported in a {"suppressed": N, "since": ...} message at most
+# every SUPPRESSION_REPORT_SECONDS.
+LINE_RATE = float(os.environ.get("LINE_RATE", 200))
+LINE_BURST = int(os.environ.get("LINE_BURST", 1000))
+SUPPRESSION_REPORT_SECONDS = float(os.environ.get("SUPPRESSION_REPORT_SECONDS", 5))
+
+# connectionId -> (TokenBucket, codec, encoding), the frame options being
+# those the summaries are sent with
+BUCKETS: dict[str, tuple] = {}
+
+# The state kept above for each connection (and its smoothed send latency)
+# is forgotten once it has not been sent to for CONNECTION_STATE_TTL_SECONDS.
+# Unsubscribes reach the Lambda as control events but not the long-running
+# service (see service), and connections deleted on $disconnect are never
+# found gone. connectionId -> monotonic time, least recently seen first.
+CONNECTION_STATE_TTL_SECONDS = int(os.environ.get("CONNECTION_STATE_TTL_SECONDS", 3600))
+LAST_SEEN: OrderedDict[str, float] = OrderedDict()
+
+# Content-based dedup of records put more than once under different sequence
+# numbers: one rotating Bloom filter per watched identifier (or route),
+# shared by its watchers, all of them within DEDUP_FILTER_BYTES. The
+# duplicates found are remembered, up to DEDUP_REPLAY_POSITIONS per
+# identifier and shard, so that they are dropped again when a batch is
+# retried.
+CONTENT_DEDUP = ContentDeduplicator(
+    max_bytes=int(os.environ.get("DEDUP_FILTER_BYTES", 4 * 1024 * 1024)),
+    fp_rate=float(os.environ.get("DEDUP_FP_RATE", 0.001)),
+    window=int(os.environ.get("DEDUP_WINDOW_SECONDS", 300)),
+    max_identifiers=int(os.environ.get("DEDUP_MAX_IDENTIFIERS", 256)),
+    max_replays=int(os.environ.get("DEDUP_REPLAY_POSITIONS", 1024)),
+)
+
 # Logging setup
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
 
-def handler(event, _ctx):
+def handler(event, ctx):
+    # Pick up edited drop/strip rules and other instances' prefix
+    # subscriptions
+    rules.refresh()
+    SUBSCRIPTIONS.refresh(ddb, TABLE)
     if event.get("type") == "control":
-        _process_control(event)
+        _process_control(event, ctx)
     elif "Records" in event:
-        _process_kinesis(event)
+        # Partial batch response: Lambda checkpoints up to the lowest failed
+        # sequence number and only retries from there
+        return {"batchItemFailures": _process_kinesis(event, ctx)}
     else:
         log.warning("Unknown event payload: %s", event)
 
 
-def _decode_data(raw_data):
-    """
-    Decode Kinesis record Data field, handling both raw JSON bytes or base64-encoded payloads.
-    """
-    if isinstance(raw_data, (bytes, bytearray)):
-        text = raw_data.decode("utf-8", errors="ignore")
-    else:
-        text = str(raw_data)
-    # Try direct JSON
-    try:
-        return json.loads(text)
-    except Exception:
-        pass
-    # Try base64 then JSON
-    try:
-        decoded = base64.b64decode(text)
-        return json.loads(decoded)
-    except Exception:
-        log.warning("Failed to decode record Data")
-        return None
-
-
-def _process_control(payload: dict):
+def _process_control(payload: dict, ctx=None):
     cid = payload["connectionId"]
     action = payload["action"]
 
@@ -66,108 +146,308 @@ def _process_control(payload: dict):
         # Ensure identifiers is always a list
         if not isinstance(identifiers, list):
             identifiers = [identifiers]
+        prefixes = payload.get("identifierPrefix") or []
+        routes = payload.get("routes") or []
 
         # Skip if empty list
-        if not identifiers:
+        if not identifiers and not prefixes and not routes:
             log.warning("Empty identifierId list for connection %s, skipping", cid)
             return
 
+        # A back-fill, first or continued, only goes on while the connection
+        # keeps the subscription it was started for: not after a stopStream,
+        # another streamLogs or a disconnect
+        row = _subscription_row(cid, payload.get("subscriptionId"))
+        if row is None:
+            log.info("Subscription of %s changed, dropping its back-fill", cid)
+            return
+
         IDENTIFIER_FILTER[cid] = identifiers
-        log.info("Subscribed %s → %s", cid, identifiers)
+        SUBSCRIPTIONS.refresh(ddb, TABLE, force=True)
+        log.info(
+            "Subscribed %s → %s, prefixes %s, routes %s",
+            cid,
+            identifiers,
+            prefixes,
+            routes,
+        )
 
-        # Back-fill: read all shards from TRIM_HORIZON to now
-        try:
-            shards = kinesis.describe_stream(StreamName=STREAM)["StreamDescription"][
-                "Shards"
-            ]
-            log.info("Starting backfill for identifiers: %s", identifiers)
-            log.info("Found %d shards in stream", len(shards))
-
-            for shard in shards:
-                shard_id = shard["ShardId"]
-                log.info("Processing shard: %s", shard_id)
-
-                # Get shard iterator
-                it = kinesis.get_shard_iterator(
-                    StreamName=STREAM,
-                    ShardId=shard_id,
-                    ShardIteratorType="TRIM_HORIZON",
-                )["ShardIterator"]
-
-                # Process records from shard
-                while it:
-                    resp = kinesis.get_records(ShardIterator=it, Limit=1000)
-                    it = resp.get("NextShardIterator")
-                    records = resp.get("Records", [])
-
-                    if not records:
-                        break
-
-                    for rec in records:
-                        logdata = _decode_data(rec.get("Data"))
-                        if not logdata:
-                            continue
-
-                        # Check if record matches any subscribed identifier
-                        record_id = logdata.get("identifierId")
-                        if not record_id:
-                            continue
-
-                        # Handle both string and list cases
-                        record_ids = (
-                            record_id if isinstance(record_id, list) else [record_id]
-                        )
+        # A new subscription replays history, a continued back-fill does not
+        if "position" not in payload:
+            WATERMARKS.pop(cid, None)
+            LIVE_STARTS.pop(cid, None)
+        # and skips what other containers delivered of it
+        _load_watermarks(cid, row)
 
-                        # Check if any record ID matches any subscribed ID
-                        if any(
-                            str(rid).strip() == str(sub_id).strip()
-                            for rid in record_ids
-                            for sub_id in identifiers
-                        ):
-                            try:
-                                # Process log before sending
-                                processed_log = extract_log_item(logdata)
-                                mgmt.post_to_connection(
-                                    ConnectionId=cid,
-                                    Data=json.dumps(processed_log).encode(),
-                                )
-                            except mgmt.exceptions.GoneException:
-                                log.warning("Connection %s gone during backfill", cid)
-                                IDENTIFIER_FILTER.pop(cid, None)
-                                return
-                            except Exception as e:
-                                log.error(
-                                    "Error sending backfill to %s: %s", cid, str(e)
-                                )
-
-                    # Throttle to avoid Kinesis limits
-                    sleep(0.1)
-
-            log.info("Back-fill complete for %s → %s", cid, identifiers)
+        try:
+            _backfill({**payload, "identifierId": identifiers}, ctx)
         except Exception as e:
             log.error("Backfill error for %s: %s", cid, str(e))
 
     elif action == "drop":
+        SUBSCRIPTIONS.drop(cid)
+        _forget(cid)
         if cid in IDENTIFIER_FILTER:
             IDENTIFIER_FILTER.pop(cid, None)
             log.info("Unsubscribed %s", cid)
 
 
-def _process_kinesis(event):
-    # Decode real-time batch
-    logs = []
+def _backfill(payload: dict, ctx=None):
+    """
+    Back-fill: read all shards from TRIM_HORIZON to now.
+
+    A continued back-fill carries "position" (shardId -> last record position
+    handled, see decode.position) and "completed" (finished shardIds) in its
+    control event. When
+    the invocation runs out of time, both are saved into a new control event
+    and the consumer re-invokes itself to carry on from there.
+    """
+    cid = payload["connectionId"]
+    identifiers = payload["identifierId"]
+    prefixes = tuple(payload.get("identifierPrefix") or ())
+    routes = {tuple(route) for route in payload.get("routes") or ()}
+    codec = payload.get("codec")
+    fmt = payload.get("format")
+    encoding = payload.get("encoding")
+    accept = compile_filter(payload.get("filter"))
+    checkpoint = dict(payload.get("position") or {})
+    completed = list(payload.get("completed") or [])
+
+    shards = kinesis.describe_stream(StreamName=STREAM)["StreamDescription"]["Shards"]
+    log.info("Starting backfill for identifiers: %s", identifiers)
+    log.info("Found %d shards in stream", len(shards))
+
+    for shard in shards:
+        shard_id = shard["ShardId"]
+        if shard_id in completed:
+            continue
+        log.info("Processing shard: %s", shard_id)
+
+        # Get shard iterator, resuming at the record of the saved position
+        # (which may be part-way through an aggregated record) if any
+        if shard_id in checkpoint:
+            it = kinesis.get_shard_iterator(
+                StreamName=STREAM,
+                ShardId=shard_id,
+                ShardIteratorType="AT_SEQUENCE_NUMBER",
+                StartingSequenceNumber=str(int(checkpoint[shard_id]) >> SUB_BITS),
+            )["ShardIterator"]
+        else:
+            it = kinesis.get_shard_iterator(
+                StreamName=STREAM,
+                ShardId=shard_id,
+                ShardIteratorType="TRIM_HORIZON",
+            )["ShardIterator"]
+
+        # Process records from shard
+        while it:
+            if _out_of_time(ctx):
+                _continue_backfill(payload, checkpoint, completed, ctx)
+                return
+
+            resp = kinesis.get_records(ShardIterator=it, Limit=1000)
+            it = resp.get("NextShardIterator")
+            records = resp.get("Records", [])
+
+            if not records:
+                break
+
+            # Collect the matching records of this page and send them
+            # packed into as few frames as possible
+            processed_logs = []
+            mark = int(checkpoint.get(shard_id, -1))
+            for rec, sub, data, logdata in _user_records(records):
+                handle = {"shardId": shard_id, "sequenceNumber": rec["SequenceNumber"]}
+                if sub is not None:
+                    handle["subSequenceNumber"] = sub
+                at = handle_position(handle)
+
+                # Already delivered to this connection
+                if at <= mark:
+                    continue
+
+                if not logdata:
+                    log.warning("Failed to decode record Data")
+                    continue
+
+                # Check if record matches any subscribed identifier
+                record_id = logdata.get("identifierId") or []
+
+                # Handle both string and list cases
+                record_ids = record_id if isinstance(record_id, list) else [record_id]
+
+                # Check if any record ID matches any subscribed ID
+                matched = [
+                    rid
+                    for rid in record_ids
+                    if any(
+                        str(rid).strip() == str(sub_id).strip()
+                        for sub_id in identifiers
+                    )
+                    or (prefixes and str(rid).strip().startswith(prefixes))
+                ]
+                # or any subscribed route
+                values = route_values(logdata) if routes else None
+                if values is not None and not routes.isdisjoint(route_keys(values)):
+                    matched.append(_route_name(values))
+                if matched and not any(
+                    CONTENT_DEDUP.is_duplicate(str(rid), shard_id, at, data)
+                    for rid in matched
+                ):
+                    # Process log before sending
+                    processed_log = normalize_record(logdata)
+                    if (
+                        processed_log.get("log", "")
+                        and not _delivered_live(cid, processed_log, handle)
+                        and (accept is None or accept(processed_log))
+                    ):
+                        processed_logs.append((processed_log, handle))
+
+            sent = 0
+            sender = _sender(ctx)
+            try:
+                for frame, count in pack_frames(
+                    processed_logs, fmt=fmt, encoding=encoding
+                ):
+                    if _out_of_time(ctx):
+                        # Resume after the last record that was sent
+                        if sent:
+                            checkpoint[shard_id] = str(
+                                handle_position(processed_logs[sent - 1][1])
+                            )
+                        _continue_backfill(payload, checkpoint, completed, ctx)
+                        return
+                    sender.post_now(cid, encode_frame(frame, codec))
+                    _advance_watermarks(cid, processed_logs[sent : sent + count])
+                    sent += count
+            except mgmt.exceptions.GoneException:
+                log.warning("Connection %s gone during backfill", cid)
+                _mark_gone(cid)
+                _delete_connections([cid])
+                return
+            except Exception as e:
+                log.error("Error sending backfill to %s: %s", cid, str(e))
+
+            checkpoint[shard_id] = str(
+                position(records[-1]["SequenceNumber"], END_OF_RECORD)
+            )
+            if sent:
+                _save_watermarks(cid, payload.get("subscriptionId"))
+
+            # Throttle to avoid Kinesis limits
+            sleep(0.1)
+
+        completed.append(shard_id)
+
+    log.info("Back-fill complete for %s → %s", cid, identifiers)
+
+
+def _subscription_row(cid, subscription):
+    """The connection's row if it still holds the given subscription, else None."""
+    item = ddb.get_item(
+        TableName=TABLE, Key={"PK": {"S": f"CONN#{cid}"}}, ConsistentRead=True
+    ).get("Item")
+    if item is None or item.get("subscriptionId", {}).get("S") != subscription:
+        return None
+    return item
+
+
+def _user_records(records):
+    """
+    Yield (record, subSequenceNumber, raw, logdata) for every log item of a
+    page of GetRecords results (see decode.decode_records).
+    """
+    for rec in records:
+        try:
+            user_records = decode_records(rec.get("Data"))
+        except Exception as e:
+            log.warning("Failed to decode record Data: %s", str(e))
+            continue
+        for sub, data, logdata in user_records:
+            yield rec, sub, data, logdata
+
+
+def _continue_backfill(payload, checkpoint, completed, ctx):
+    """Re-invoke the consumer to resume a back-fill from the saved position."""
+    log.warning(
+        "Backfill for %s out of time, continuing in a new invocation",
+        payload["connectionId"],
+    )
+    _save_watermarks(payload["connectionId"], payload.get("subscriptionId"))
+    lambdacli.invoke(
+        FunctionName=ctx.invoked_function_arn,
+        InvocationType="Event",
+        Payload=jsoncodec.dumps(
+            {**payload, "position": checkpoint, "completed": completed}
+        ),
+    )
+
+
+def _time_left(ctx, started=None):
+    """
+    Seconds left before DEADLINE_MARGIN_MS of the timeout and, for a batch
+    started at the given monotonic time, before its BATCH_BUDGET_MS runs
+    out. None when there is neither.
+    """
+    left = None
+    if ctx is not None:
+        left = (ctx.get_remaining_time_in_millis() - DEADLINE_MARGIN_MS) / 1000
+    if started is not None and BATCH_BUDGET_MS:
+        budget = BATCH_BUDGET_MS / 1000 - (monotonic() - started)
+        left = budget if left is None else min(left, budget)
+    return left
+
+
+def _out_of_time(ctx):
+    """True once the invocation is within DEADLINE_MARGIN_MS of its timeout."""
+    return ctx is not None and ctx.get_remaining_time_in_millis() < DEADLINE_MARGIN_MS
+
+
+def _process_kinesis(event, ctx=None):
+    """
+    Fan a real-time batch out to the subscribed connections and return the
+    batch item failures: the records whose delivery failed for a reason worth
+    retrying, or that were not delivered before the invocation ran out of
+    time. Undecodable records and gone connections are not retried.
+    """
+    started = monotonic()
+    _forget_idle()
+
+    # Decode real-time batch, expanding KPL-aggregated records and CloudWatch
+    # Logs envelopes. Log items are keyed by sequence number
+    # ("<seq>:<subSequenceNumber>" for expanded records) so that each is
+    # normalized once and delivered at most once per connection.
+    records: dict[str, dict] = {}
+    raw: dict[str, bytes] = {}
+    handles: dict[str, dict] = {}
     for r in event.get("Records", []):
         try:
-            data = base64.b64decode(r["kinesis"]["data"])
-            logs.append(json.loads(data))
+            seq = r["kinesis"]["sequenceNumber"]
+            user_records = decode_records(base64.b64decode(r["kinesis"]["data"]))
         except Exception:
             log.warning("Skipping invalid realtime record")
+            continue
 
-    log.info("Real-time batch: %d records", len(logs))
-
-    # Group logs by identifier
+        for sub, data, logdata in user_records:
+            if logdata is None:
+                log.warning("Skipping invalid realtime record")
+                continue
+            key = seq if sub is None else f"{seq}:{sub}"
+            records[key] = logdata
+            raw[key] = data
+            # eventID is "<shardId>:<sequenceNumber>"
+            handles[key] = {
+                "shardId": r.get("eventID", "").split(":", 1)[0],
+                "sequenceNumber": seq,
+            }
+            if sub is not None:
+                handles[key]["subSequenceNumber"] = sub
+
+    log.info("Real-time batch: %d records", len(records))
+
+    # Group sequence numbers by identifier
     by_identifier: dict[str, list] = {}
-    for l in logs:
+    for seq, l in records.items():
         record_id = l.get("identifierId")
         if not record_id:
             continue
@@ -181,227 +461,441 @@ def _process_kinesis(event):
             continue
 
         for id in record_ids:
-            if id:  # Skip empty identifiers
-                by_identifier.setdefault(id, []).append(l)
+            if not id:  # Skip empty identifiers
+                continue
+            by_identifier.setdefault(id, []).append(seq)
+
+    # and by route values, for the route subscriptions
+    by_route: dict[tuple, list] = {}
+    for seq, l in records.items():
+        values = route_values(l)
+        if values is not None:
+            by_route.setdefault(values, []).append(seq)
+
+    # Merge the records of every identifier and route a connection watches
+    # into one set, so a record matching several subscriptions is only sent
+    # once. The identifiers and routes it gets records of make its flow, what
+    # the send layer shares the batch fairly between (see sender.Sender).
+    # Content duplicates are only looked for in the identifiers and routes
+    # someone watches.
+    duplicates = 0
+    by_connection: dict[str, set] = {}
+    flows: dict[str, list] = {}
+    connections: dict[str, dict] = {}
+    failed: set[str] = set()
+    for identifier, seqs in by_identifier.items():
+        if _out_of_time(ctx):
+            failed.update(seqs)
+            continue
 
-    # Process for each identifier that has logs
-    for identifier, identifier_logs in by_identifier.items():
-        if not identifier or not identifier_logs:
+        subscribers = {
+            cid: item
+            for cid, item in SUBSCRIPTIONS.match(identifier).items()
+            if not _is_gone(cid)
+        }
+        if not subscribers:
+            continue
+        seqs = _unique(identifier, seqs, handles, raw)
+        duplicates += len(by_identifier[identifier]) - len(seqs)
+        for cid, item in subscribers.items():
+            by_connection.setdefault(cid, set()).update(seqs)
+            flows.setdefault(cid, []).append(identifier)
+            connections[cid] = item
+    for values, seqs in by_route.items():
+        subscribers = {
+            cid: item
+            for cid, item in SUBSCRIPTIONS.route(values).items()
+            if not _is_gone(cid)
+        }
+        if not subscribers:
+            continue
+        seqs = _unique(_route_name(values), seqs, handles, raw)
+        duplicates += len(by_route[values]) - len(seqs)
+        for cid, item in subscribers.items():
+            by_connection.setdefault(cid, set()).update(seqs)
+            flows.setdefault(cid, []).append(values)
+            connections[cid] = item
+
+    # Normalize each record once, however many connections receive it, and
+    # evaluate each filter once per record: (filter spec, seq) -> passes
+    processed: dict[str, dict] = {}
+    verdicts: dict[tuple, bool] = {}
+    # Watchers receiving the same lines with the same frame options share
+    # the encoded frames: (seqs, format, encoding, codec) -> [(data, count)]
+    packed: dict[tuple, list] = {}
+
+    # Connections found gone in this batch, deleted together at the end
+    gone: list[str] = []
+    # Connections whose marks moved, saved on their rows once sent
+    advanced: set[str] = set()
+    suppressed = 0
+
+    # Frames are queued per connection and lane, ordered by Kinesis sequence
+    # number, and sent together at the end
+    sender = _sender(ctx, on_gone=gone.append, started=started)
+    for cid, seqs in by_connection.items():
+        left = sender.time_left()
+        if left is not None and left <= 0:
+            failed.update(seqs)
             continue
 
+        # The (item, handle) entries to send and their sequence numbers
+        lines, pending = [], []
+        if cid not in WATERMARKS:
+            _load_watermarks(cid, connections[cid])
+        marks = WATERMARKS.get(cid, {})
+        spec = connections[cid].get("filterSpec", {}).get("S")
+        accept = compile_filter(spec)
         try:
-            # Query DynamoDB for connections subscribed to this identifier
-            resp = ddb.query(
-                TableName=TABLE,
-                IndexName=GSI,
-                KeyConditionExpression="identifierIdGSI = :id",
-                ExpressionAttributeValues={":id": {"S": identifier}},
-            )
-
-            # Get additional matches through filtering
-            scan_resp = ddb.scan(
-                TableName=TABLE,
-                FilterExpression="contains(identifierId, :id) AND attribute_not_exists(identifierIdGSI)",
-                ExpressionAttributeValues={":id": {"S": identifier}},
-            )
-
-            # Combine results
-            items = resp.get("Items", []) + scan_resp.get("Items", [])
-
-            # Send logs to each connection
-            for item in items:
-                cid = item["PK"]["S"].split("#", 1)[1]
-                try:
-                    # Process logs through extract_log_item before sending
-                    processed_logs = []
-                    for log_item in identifier_logs:
-                        processed_log = extract_log_item(log_item)
-                        # Skip empty logs
-                        if processed_log.get("log", ""):
-                            processed_logs.append(processed_log)
-
-                    if processed_logs:
-                        mgmt.post_to_connection(
-                            ConnectionId=cid, Data=json.dumps(processed_logs).encode()
+            for seq in sorted(seqs, key=lambda seq: handle_position(handles[seq])):
+                if seq not in processed:
+                    processed[seq] = normalize_record(records[seq])
+                # Skip empty logs, those already delivered to this connection
+                if not processed[seq].get("log", ""):
+                    continue
+                if _delivered(marks, processed[seq], handles[seq]):
+                    continue
+                # and those the connection filtered out
+                if accept is not None:
+                    if (spec, seq) not in verdicts:
+                        verdicts[spec, seq] = accept(processed[seq])
+                    if not verdicts[spec, seq]:
+                        continue
+                lines.append((processed[seq], handles[seq]))
+                pending.append(seq)
+
+            # Frame format, encoding and compression codec negotiated at
+            # subscribe time
+            codec = connections[cid].get("codec", {}).get("S")
+            fmt = connections[cid].get("frameFormat", {}).get("S")
+            encoding = connections[cid].get("frameEncoding", {}).get("S")
+
+            # Lines are sent in sequence order, in one lane. Only when some
+            # are over the connection's line budget, or time is about to run
+            # out, do urgent lines get a lane of their own, sent and kept
+            # ahead of the others.
+            bucket = _bucket(cid, connections[cid], codec, encoding)
+            granted = bucket.take(len(lines))
+            left = sender.time_left()
+            lanes = {"normal": (lines, pending)}
+            if granted < len(lines) or (left is not None and left < SEND_URGENT_WINDOW):
+                lanes = {lane: ([], []) for lane in LANES}
+                for entry, seq in zip(lines, pending):
+                    lane_lines, lane_pending = lanes[_lane(entry[0])]
+                    lane_lines.append(entry)
+                    lane_pending.append(seq)
+                # Drop what is over the budget, urgent lines last
+                suppressed += len(lines) - granted
+                for lane_lines, lane_pending in lanes.values():
+                    del lane_lines[granted:], lane_pending[granted:]
+                    granted -= len(lane_lines)
+
+            for lane, (lane_lines, lane_pending) in lanes.items():
+                key = (tuple(lane_pending), fmt, encoding, codec)
+                if key not in packed:
+                    packed[key] = [
+                        (encode_frame(frame, codec), count)
+                        for frame, count in pack_frames(
+                            lane_lines, fmt=fmt, encoding=encoding
                         )
-                        log.info(
-                            "Pushed %d logs to %s for identifier %s",
-                            len(processed_logs),
+                    ]
+                start = 0
+                for data, count in packed[key]:
+                    sender.enqueue(
+                        cid,
+                        data,
+                        on_sent=partial(
+                            _advance_watermarks,
                             cid,
-                            identifier,
-                        )
-                except mgmt.exceptions.GoneException:
-                    log.warning("Connection %s gone, removing record", cid)
-                    try:
-                        ddb.delete_item(
-                            TableName=TABLE, Key={"PK": {"S": f"CONN#{cid}"}}
-                        )
-                    except Exception as e:
-                        log.error(
-                            "Failed to delete gone connection %s: %s", cid, str(e)
-                        )
-                except Exception as e:
-                    log.error("Error sending logs to %s: %s", cid, str(e))
+                            lane_lines[start : start + count],
+                            live=True,
+                            touched=advanced,
+                        ),
+                        on_failed=partial(
+                            failed.update, lane_pending[start : start + count]
+                        ),
+                        flow=tuple(flows[cid]),
+                        lane=lane,
+                    )
+                    start += count
         except Exception as e:
-            log.error("Error processing identifier %s: %s", identifier, str(e))
+            log.error("Error packing logs for %s: %s", cid, str(e))
+            failed.update(pending)
+
+    # Report suppressed lines, also to connections without lines in this batch
+    for cid in list(BUCKETS):
+        bucket, codec, encoding = BUCKETS[cid]
+        summary = bucket.summary(SUPPRESSION_REPORT_SECONDS)
+        if summary is not None:
+            sender.enqueue(cid, encode_frame(encode_message(summary, encoding), codec))
+
+    sender.flush()
+    for cid in advanced:
+        _save_watermarks(cid, connections[cid].get("subscriptionId", {}).get("S"))
+    metrics.emit({"SendThrottles": sender.throttled})
+    if sender.latencies:
+        metrics.emit(
+            {
+                "SendLatencyAvg": 1000 * sum(sender.latencies) / len(sender.latencies),
+                "SendLatencyMax": 1000 * max(sender.latencies),
+                # Slowest connection by smoothed latency, what its retries
+                # are paced by
+                "SendLatencySmoothedMax": 1000 * max(LATENCY.values(), default=0),
+            },
+            unit="Milliseconds",
+        )
+    # Time from the start of the batch to the delivery of each frame
+    for lane, delays in sender.delays.items():
+        if not delays:
+            continue
+        delays.sort()
+        metrics.emit(
+            {
+                "DeliveryDelayP50": 1000 * delays[len(delays) // 2],
+                "DeliveryDelayP99": 1000 * delays[len(delays) * 99 // 100],
+                "DeliveryDelayMax": 1000 * delays[-1],
+            },
+            unit="Milliseconds",
+            Lane=lane,
+        )
+
+    _delete_connections(gone)
+
+    metrics.emit({"ContentDuplicates": duplicates})
+    metrics.emit({"SuppressedLines": suppressed})
+    metrics.emit({"DedupFilterBytes": CONTENT_DEDUP.nbytes}, unit="Bytes")
+    # Lines stripped or dropped per rule, back-fills included
+    for name, hits in rules.ACTIVE.take_hits().items():
+        metrics.emit({"RuleHits": hits}, Rule=name)
+    for log_type, (lines, seconds) in take_stats().items():
+        metrics.emit({"NormalizedLines": lines}, LogType=log_type)
+        metrics.emit(
+            {"NormalizeTime": round(seconds * 1e6)},
+            unit="Microseconds",
+            LogType=log_type,
+        )
+
+    # Failures are reported per Kinesis record, not per user record
+    failed = {handles[seq]["sequenceNumber"] for seq in failed}
+    if failed:
+        log.warning("Reporting %d failed records for retry", len(failed))
+    return [{"itemIdentifier": seq} for seq in sorted(failed, key=int)]
+
+
+def _sender(ctx, on_gone=None, started=None):
+    """
+    A send layer posting to the management API within the deadline and,
+    for a batch started at the given monotonic time, its budget.
+    """
 
+    def gone(cid):
+        _mark_gone(cid)
+        if on_gone:
+            on_gone(cid)
 
-log_filter_string = [
-    "By pulling and using the container, you accept the terms and conditions of this license:"
-]
+    return Sender(
+        post=lambda cid, data: mgmt.post_to_connection(ConnectionId=cid, Data=data),
+        is_gone=lambda e: isinstance(e, mgmt.exceptions.GoneException),
+        time_left=partial(_time_left, ctx, started),
+        on_gone=gone,
+        started=started,
+    )
 
 
-def extract_log_item(log_item, type="BUILD", ignore=False):
+def _bucket(cid, item, codec, encoding):
+    """
+    The token bucket of a connection, with the line rate and burst of its
+    row (capped by the registrar) or the defaults.
+    """
+    rate = float(item.get("lineRate", {}).get("N", LINE_RATE))
+    burst = int(item.get("lineBurst", {}).get("N", LINE_BURST))
+    if cid in BUCKETS:
+        bucket = BUCKETS[cid][0]
+        bucket.configure(rate, burst)
+    else:
+        bucket = TokenBucket(rate, burst)
+    BUCKETS[cid] = (bucket, codec, encoding)
+    _seen(cid)
+    return bucket
+
+
+def _advance_watermarks(cid, entries, live=False, touched=None):
+    """
+    Raise the connection's per-shard marks past the (item, handle) entries
+    sent, by the real-time fan-out when live, adding it to touched if given.
+    """
+    _seen(cid)
+    if touched is not None:
+        touched.add(cid)
+    marks = WATERMARKS.setdefault(cid, {})
+    starts = LIVE_STARTS.setdefault(cid, {}) if live else None
+    for item, handle in entries:
+        lane_marks = marks.setdefault(_lane(item), {})
+        at = handle_position(handle)
+        if at > lane_marks.get(handle["shardId"], -1):
+            lane_marks[handle["shardId"]] = at
+        if live and at < starts.get(handle["shardId"], at + 1):
+            starts[handle["shardId"]] = at
+
+
+def _save_watermarks(cid, subscription):
+    """
+    Save the marks of a connection on its row, as long as it holds the
+    subscription they were made for. Positions are saved as strings, being
+    wider than DynamoDB numbers.
+    """
+    if subscription is None:
+        return
+    saved = {
+        "marks": {
+            lane: {shard_id: str(at) for shard_id, at in shards.items()}
+            for lane, shards in WATERMARKS.get(cid, {}).items()
+        },
+        "liveStarts": {
+            shard_id: str(at) for shard_id, at in LIVE_STARTS.get(cid, {}).items()
+        },
+    }
     try:
-        # Make a copy of the entire log item to preserve all fields
-        temp_log_data = log_item.copy() if isinstance(log_item, dict) else {}
-
-        if isinstance(log_item, str):
-            temp = json.loads(log_item)
-        elif isinstance(log_item, dict):
-            temp = log_item
-
-        # Debug input
-        log.info("Processing log item: %s", json.dumps(temp)[:200])
-
-        # Ensure time field exists
-        if "time" in temp:
-            temp_log_data["time"] = temp["time"]
-        elif "@timestamp" in temp:
-            temp_log_data["time"] = temp["@timestamp"]
-        else:
-            # Default time if missing
-            temp_log_data["time"] = "unknown"
+        ddb.update_item(
+            TableName=TABLE,
+            Key={"PK": {"S": f"CONN#{cid}"}},
+            UpdateExpression="SET deliveryMarks = :marks",
+            ConditionExpression="subscriptionId = :subscription",
+            ExpressionAttributeValues={
+                ":marks": {"S": jsoncodec.dumps(saved).decode()},
+                ":subscription": {"S": subscription},
+            },
+        )
+    except ddb.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as e:
+        log.warning("Could not save the marks of %s: %s", cid, str(e))
 
-        # Get the log content, with fallback
-        log_content = temp.get("log", "")
-        if not log_content and "message" in temp:
-            log_content = temp.get("message", "")
 
-        log.info("Original log content: %s", log_content[:100])
+def _load_watermarks(cid, item):
+    """Merge the marks saved on a connection's row into those in memory."""
+    saved = item.get("deliveryMarks", {}).get("S")
+    if not saved:
+        return
+    try:
+        saved = jsoncodec.loads(saved)
+        marks = WATERMARKS.setdefault(cid, {})
+        for lane, shards in saved.get("marks", {}).items():
+            lane_marks = marks.setdefault(lane, {})
+            for shard_id, at in shards.items():
+                lane_marks[shard_id] = max(int(at), lane_marks.get(shard_id, -1))
+        starts = LIVE_STARTS.setdefault(cid, {})
+        for shard_id, at in saved.get("liveStarts", {}).items():
+            starts[shard_id] = min(int(at), starts.get(shard_id, int(at)))
+    except Exception as e:
+        log.warning("Ignoring the saved marks of %s: %s", cid, str(e))
+    _seen(cid)
 
-        # Ensure stream field
-        if "stream" in temp:
-            temp_log_data["stream"] = temp["stream"]
-        else:
-            temp_log_data["stream"] = "stdout"
-
-        # Preserve identifierId if present
-        if "identifierId" in temp:
-            temp_log_data["identifierId"] = temp["identifierId"]
-
-        # Process the log content
-        if type == "INFERENCE":
-            temp_log_data["log"] = re.sub(r"^I.*?\]", "", log_content)
-        elif type == "BUILD":
-            temp_log_data["log"] = re.sub(r"^\[.*?\]", "", log_content)
-            temp_log_data["log"] = re.sub(r"^I.*?\]", "", temp_log_data["log"])
-        else:
-            temp_log_data["log"] = log_content
 
-        # Trim any leading/trailing whitespace after timestamp removal
-        if "log" in temp_log_data:
-            temp_log_data["log"] = temp_log_data["log"].strip()
+def _delivered(marks, item, handle):
+    """True if a normalized item is at or below the mark of its lane."""
+    lane_marks = marks.get(_lane(item), {})
+    return handle_position(handle) <= lane_marks.get(handle["shardId"], -1)
 
-        if not ignore:
-            pattern = re.compile(r"(?i)(nvidia|triton)")
-            if re.search(pattern, temp_log_data["log"]):
-                temp_log_data["log"] = ""
 
-        # Check for specific filter strings
-        if log_content in log_filter_string:
-            temp_log_data["log"] = ""
+def _delivered_live(cid, item, handle):
+    """True if the real-time fan-out already sent a normalized item."""
+    start = LIVE_STARTS.get(cid, {}).get(handle["shardId"])
+    if start is None or handle_position(handle) < start:
+        return False
+    return _delivered(WATERMARKS.get(cid, {}), item, handle)
 
-        # Special identifier removal - handle this first and directly
-        log.info(
-            "Before identifier removal: %s",
-            temp_log_data["log"][:100] if "log" in temp_log_data else "No log content",
+
+def _unique(name, seqs, handles, raw):
+    """The sequence numbers of seqs whose record is no content duplicate under name."""
+    return [
+        seq
+        for seq in seqs
+        if not CONTENT_DEDUP.is_duplicate(
+            name, handles[seq]["shardId"], handle_position(handles[seq]), raw[seq]
         )
+    ]
 
-        # Get exact pattern from the log line
-        if "identifierId" in temp:
-            identifier = temp["identifierId"]
-            if isinstance(identifier, list) and identifier:
-                identifier = identifier[0]
-            elif not isinstance(identifier, str):
-                identifier = None
-        else:
-            identifier = None
-
-        # Extract any hex identifier that might be at the start
-        if "log" in temp_log_data and temp_log_data["log"]:
-            # Try the exact pattern with the known identifier first
-            if identifier:
-                log.info("Using identifier: %s", identifier)
-
-                # Direct string replacement - for exact match at start of string after trimming
-                if temp_log_data["log"].startswith(identifier):
-                    # Check if followed by " - "
-                    rest = temp_log_data["log"][len(identifier) :].lstrip()
-                    if rest.startswith("- "):
-                        temp_log_data["log"] = rest[
-                            2:
-                        ].strip()  # Remove "- " and any whitespace
-                        log.info("Removed identifier using exact start match")
-
-                # Pattern for identifier anywhere in the string with possible whitespace
-                pattern = r"(?:\s|^)" + re.escape(identifier) + r"\s*-\s*"
-                before = temp_log_data["log"]
-                temp_log_data["log"] = re.sub(
-                    pattern,
-                    " ",
-                    temp_log_data["log"],
-                    count=1,  # Add count=1 to prevent multiple replacements
-                ).strip()
-                if before != temp_log_data["log"]:
-                    log.info("Removed with flexible pattern")
-
-            # Generic pattern for any hex ID of any length
-            pattern = r"(?:\s|^)([a-f0-9]{32})\s*-\s*"
-            before = temp_log_data["log"]
-            temp_log_data["log"] = re.sub(
-                pattern, " ", temp_log_data["log"], count=1
-            ).strip()
-            if before != temp_log_data["log"]:
-                log.info("Removed with generic hex pattern")
-
-            # Extra pattern specifically for your log format from the example
-            specific_pattern = r"([a-f0-9]{32})\s*-\s*"
-            before = temp_log_data["log"]
-            temp_log_data["log"] = re.sub(
-                specific_pattern, "", temp_log_data["log"], count=1
-            ).strip()
-            if before != temp_log_data["log"]:
-                log.info("Removed with specific pattern match")
-
-            # If all else fails, try a brutal force approach for this specific identifier
-            if identifier and identifier in temp_log_data["log"]:
-                parts = temp_log_data["log"].split(identifier + " - ", 1)
-                if len(parts) > 1:
-                    temp_log_data["log"] = parts[1].strip()
-                    log.info("Removed using string split")
-
-            # Final cleanup to ensure any remaining dash at beginning is removed
-            temp_log_data["log"] = re.sub(
-                r"^[\s-]+", "", temp_log_data["log"], count=1
-            ).strip()
-
-            # Extreme fallback - if we still have a dash at the beginning, remove it
-            if temp_log_data["log"].startswith("-"):
-                temp_log_data["log"] = temp_log_data["log"][1:].strip()
-                log.info("Removed leading dash with fallback")
-
-            # Check for specific pattern: dash followed by whitespace at beginning
-            if temp_log_data["log"].startswith("- "):
-                temp_log_data["log"] = temp_log_data["log"][2:].strip()
-                log.info("Removed '- ' prefix")
 
-        log.info(
-            "Final extracted log: %s",
-            temp_log_data["log"][:100] if "log" in temp_log_data else "No log content",
-        )
-        return temp_log_data
+def _route_name(values):
+    """The route values of a record as one "modelId/logType" string."""
+    return "/".join(value for value in values if value is not None)
 
-    except Exception as e:
-        log.error("Error in extract_log_item: %s", str(e))
-        return log_item
+
+def _lane(item):
+    """The lane (see sender.LANES) a normalized item is sent in."""
+    if item.get("stream") == "stderr" or item.get("level") in URGENT_LEVELS:
+        return "urgent"
+    return "normal"
+
+
+def _is_gone(cid):
+    """True if the connection was found gone within GONE_TTL_SECONDS."""
+    seen = GONE_CONNECTIONS.get(cid)
+    if seen is None:
+        return False
+    if monotonic() - seen > GONE_TTL_SECONDS:
+        GONE_CONNECTIONS.pop(cid, None)
+        return False
+    return True
+
+
+def _mark_gone(cid):
+    """Remember a gone connection and drop the state kept for it."""
+    GONE_CONNECTIONS[cid] = monotonic()
+    IDENTIFIER_FILTER.pop(cid, None)
+    SUBSCRIPTIONS.drop(cid)
+    _forget(cid)
+
+
+def _seen(cid):
+    """Keep the state of a connection for another CONNECTION_STATE_TTL_SECONDS."""
+    LAST_SEEN[cid] = monotonic()
+    LAST_SEEN.move_to_end(cid)
+
+
+def _forget(cid):
+    """Drop the state kept for a connection."""
+    WATERMARKS.pop(cid, None)
+    LIVE_STARTS.pop(cid, None)
+    BUCKETS.pop(cid, None)
+    LATENCY.pop(cid, None)
+    LAST_SEEN.pop(cid, None)
+
+
+def _forget_idle():
+    """Drop the state of the connections not seen for CONNECTION_STATE_TTL_SECONDS."""
+    now = monotonic()
+    while LAST_SEEN:
+        cid, seen = next(iter(LAST_SEEN.items()))
+        if now - seen <= CONNECTION_STATE_TTL_SECONDS:
+            break
+        _forget(cid)
+
+
+def _delete_connections(cids):
+    """
+    Delete the rows of gone connections with BatchWriteItem (25 keys per
+    request), retrying unprocessed keys once.
+    """
+    # Forget expired entries so the negative cache stays bounded
+    now = monotonic()
+    for cid, seen in list(GONE_CONNECTIONS.items()):
+        if now - seen > GONE_TTL_SECONDS:
+            GONE_CONNECTIONS.pop(cid, None)
+
+    cids = list(dict.fromkeys(cids))
+    for start in range(0, len(cids), 25):
+        requests = [
+            {"DeleteRequest": {"Key": {"PK": {"S": f"CONN#{cid}"}}}}
+            for cid in cids[start : start + 25]
+        ]
+        try:
+            resp = ddb.batch_write_item(RequestItems={TABLE: requests})
+            unprocessed = resp.get("UnprocessedItems", {})
+            if unprocessed:
+                resp = ddb.batch_write_item(RequestItems=unprocessed)
+            if resp.get("UnprocessedItems"):
+                log.warning("Some gone connections were not deleted")
+        except Exception as e:
+            log.error("Failed to delete gone connections %s: %s", cids, str(e))
@@ -0,0 +1,198 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import zlib
+from datetime import datetime, timezone
+
+import jsoncodec
+
+# KPL aggregated record: magic bytes, a protobuf AggregatedRecord, then the
+# MD5 digest of the protobuf message
+KPL_MAGIC = b"\xf3\x89\x9a\xc2"
+KPL_DIGEST_SIZE = 16
+
+# A (sub-)record's position in its shard orders by sequence number, then by
+# sub-sequence number within an aggregated record (or index of the event in a
+# CloudWatch Logs envelope)
+SUB_BITS = 32
+END_OF_RECORD = (1 << SUB_BITS) - 1
+
+# CloudWatch Logs subscription filters deliver gzip-compressed envelopes
+GZIP_MAGIC = b"\x1f\x8b"
+CWL_MAX_INFLATED_BYTES = int(os.environ.get("CWL_MAX_INFLATED_BYTES", 8 << 20))
+
+# How CloudWatch Logs events get their identifierId: a JSON list of
+# {"field": "logGroup" | "logStream", "pattern": regex}. The first rule whose
+# pattern matches gives the identifier, from its "identifierId" named group,
+# else its first group, else the whole match. Defaults to the log stream name.
+CWL_IDENTIFIER_RULES = [
+    (rule["field"], re.compile(rule["pattern"]))
+    for rule in json.loads(
+        os.environ.get(
+            "CWL_IDENTIFIER_RULES", '[{"field": "logStream", "pattern": ".+"}]'
+        )
+    )
+]
+
+
+def decode_records(data):
+    """
+    Expand the Data of a Kinesis record into its log items, as
+    (subSequenceNumber, raw, logdata) triples. raw is the bytes the item was
+    decoded from (used for content dedup) and logdata the decoded dict, or
+    None when it could not be decoded.
+
+    Plain records give one item with a None subSequenceNumber. KPL-aggregated
+    records give one item per user record and CloudWatch Logs envelopes one
+    item per log event, numbered in order.
+    """
+    if isinstance(data, (bytes, bytearray)) and data.startswith(GZIP_MAGIC):
+        return _cloudwatch_items(data)
+    return [(sub, raw, parse_json(raw)) for sub, raw in deaggregate(data)]
+
+
+def parse_json(data):
+    """
+    Decode a JSON object from raw bytes or from base64-encoded JSON, None if
+    it is neither.
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = str(data)
+    # Try direct JSON, then JSON with invalid UTF-8 dropped, then base64 JSON
+    for decode in (
+        jsoncodec.loads,
+        lambda data: jsoncodec.loads(data.decode("utf-8", errors="ignore")),
+        lambda data: jsoncodec.loads(base64.b64decode(data)),
+    ):
+        try:
+            value = decode(data)
+        except Exception:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+
+def deaggregate(data):
+    """
+    Split a Kinesis record into its user records, as (subSequenceNumber, data)
+    pairs. Records that are not KPL-aggregated, or whose digest does not
+    match, come back whole as [(None, data)].
+    """
+    if (
+        not isinstance(data, (bytes, bytearray))
+        or not data.startswith(KPL_MAGIC)
+        or len(data) < len(KPL_MAGIC) + KPL_DIGEST_SIZE
+    ):
+        return [(None, data)]
+
+    message = data[len(KPL_MAGIC) : -KPL_DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-KPL_DIGEST_SIZE:]:
+        return [(None, data)]
+
+    # AggregatedRecord.records (3) -> Record.data (3)
+    user_records = []
+    for number, wire, value in _fields(message):
+        if number == 3 and wire == 2:
+            payload = b""
+            for field, field_wire, field_value in _fields(value):
+                if field == 3 and field_wire == 2:
+                    payload = field_value
+            user_records.append((len(user_records), payload))
+    return user_records
+
+
+def position(seq, sub=None):
+    """Position of a record, or of one user record of an aggregated record."""
+    return int(seq) << SUB_BITS | (sub or 0)
+
+
+def handle_position(handle):
+    """Position of the record a fetch handle points to."""
+    return position(handle["sequenceNumber"], handle.get("subSequenceNumber"))
+
+
+def _cloudwatch_items(data):
+    """Inflate a CloudWatch Logs envelope and turn its log events into log items."""
+    # Inflate incrementally so that an oversized payload is refused without
+    # being expanded in full
+    inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    text = inflater.decompress(data, CWL_MAX_INFLATED_BYTES)
+    if inflater.unconsumed_tail:
+        raise ValueError(
+            "CloudWatch Logs payload over %d bytes" % CWL_MAX_INFLATED_BYTES
+        )
+
+    envelope = jsoncodec.loads(text)
+    # CONTROL_MESSAGE envelopes only check that the destination is reachable
+    if envelope.get("messageType") != "DATA_MESSAGE":
+        return []
+
+    group, stream = envelope.get("logGroup", ""), envelope.get("logStream", "")
+    identifier = _cloudwatch_identifier(envelope)
+    items = []
+    for sub, event in enumerate(envelope.get("logEvents", [])):
+        logdata = {
+            "log": event.get("message", ""),
+            "time": datetime.fromtimestamp(
+                event.get("timestamp", 0) / 1000, timezone.utc
+            )
+            .isoformat(timespec="milliseconds")
+            .replace("+00:00", "Z"),
+            "stream": "stdout",
+            "identifierId": identifier,
+            "logGroup": group,
+            "logStream": stream,
+        }
+        # Event ids are unique and kept across redeliveries
+        raw = f"{group}/{stream}/{event.get('id', sub)}".encode()
+        items.append((sub, raw, logdata))
+    return items
+
+
+def _cloudwatch_identifier(envelope):
+    for field, pattern in CWL_IDENTIFIER_RULES:
+        match = pattern.search(envelope.get(field, ""))
+        if match:
+            groups = match.groupdict()
+            if groups.get("identifierId"):
+                return groups["identifierId"]
+            return match.group(1) if pattern.groups else match.group(0)
+    return None
+
+
+def _fields(buf):
+    """Yield (field number, wire type, value) for each field of a protobuf message."""
+    i = 0
+    while i < len(buf):
+        key, i = _varint(buf, i)
+        number, wire = key >> 3, key & 7
+        if wire == 0:
+            value, i = _varint(buf, i)
+        elif wire == 2:
+            length, i = _varint(buf, i)
+            value, i = buf[i : i + length], i + length
+        elif wire == 1:
+            value, i = buf[i : i + 8], i + 8
+        elif wire == 5:
+            value, i = buf[i : i + 4], i + 4
+        else:
+            raise ValueError("unsupported protobuf wire type %d" % wire)
+        if i > len(buf):
+            raise ValueError("truncated protobuf message")
+        yield number, wire, value
+
+
+def _varint(buf, i):
+    value = shift = 0
+    while True:
+        if i >= len(buf):
+            raise ValueError("truncated protobuf varint")
+        byte = buf[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, i
+        shift += 7
@@ -0,0 +1,104 @@
+import hashlib
+import math
+from collections import OrderedDict
+from time import monotonic
+
+
+class RotatingBloomFilter:
+    """
+    Time-windowed Bloom filter made of two generations of max_bytes / 2 each.
+
+    Keys are added to the current generation and looked up in both. The
+    current generation becomes the previous one after window seconds, or once
+    it holds as many keys as it was sized for at fp_rate, so a key is
+    remembered for at least one window and the false-positive rate stays
+    bounded.
+    """
+
+    def __init__(self, max_bytes, fp_rate, window):
+        self.bits = max(8, max_bytes // 2 * 8)
+        self.hashes = max(1, round(-math.log2(fp_rate)))
+        self.capacity = max(1, int(self.bits * math.log(2) ** 2 / -math.log(fp_rate)))
+        self.window = window
+        self.current = bytearray(self.bits // 8)
+        self.previous = bytearray(self.bits // 8)
+        self.count = 0
+        self.started = monotonic()
+
+    @property
+    def nbytes(self):
+        return len(self.current) + len(self.previous)
+
+    def add(self, key: bytes) -> bool:
+        """Add a key, returning True if it was (probably) already present."""
+        if self.count >= self.capacity or monotonic() - self.started > self.window:
+            self.previous, self.current = self.current, bytearray(self.bits // 8)
+            self.count, self.started = 0, monotonic()
+
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        positions = [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+        seen = all(self.current[p >> 3] & (1 << (p & 7)) for p in positions) or all(
+            self.previous[p >> 3] & (1 << (p & 7)) for p in positions
+        )
+        for p in positions:
+            self.current[p >> 3] |= 1 << (p & 7)
+        if not seen:
+            self.count += 1
+        return seen
+
+
+class ContentDeduplicator:
+    """
+    Content-based duplicate detection for records that reach the stream more
+    than once under different sequence numbers (e.g. retried PutRecord calls).
+
+    There is one RotatingBloomFilter per identifier, shared by every
+    connection watching it, and at most max_identifiers of them (least
+    recently used are evicted), each given an equal share of max_bytes so
+    that together they never take more. A record whose position (see
+    decode.position) is at or below the highest one already checked for its
+    identifier and shard is a replay of the same record (Lambda retry,
+    back-fill): it gets the verdict it got the first time, remembered for the
+    last max_replays duplicates of each identifier and shard, rather than
+    being checked again against the filter that now holds its own content.
+    Exact replays are left to the per-connection watermarks.
+    """
+
+    def __init__(self, max_bytes, fp_rate, window, max_identifiers, max_replays):
+        self.max_bytes = max_bytes
+        self.filter_bytes = max(1, max_bytes // max_identifiers)
+        self.fp_rate = fp_rate
+        self.window = window
+        self.max_identifiers = max_identifiers
+        self.max_replays = max_replays
+        # identifier -> (filter, shardId -> highest position checked,
+        # shardId -> positions found duplicate, oldest first)
+        self.filters: OrderedDict[str, tuple] = OrderedDict()
+
+    @property
+    def nbytes(self):
+        return sum(bloom.nbytes for bloom, _, _ in self.filters.values())
+
+    def is_duplicate(self, identifier, shard_id, position, data: bytes) -> bool:
+        if identifier in self.filters:
+            self.filters.move_to_end(identifier)
+        else:
+            bloom = RotatingBloomFilter(self.filter_bytes, self.fp_rate, self.window)
+            self.filters[identifier] = (bloom, {}, {})
+            if len(self.filters) > self.max_identifiers:
+                self.filters.popitem(last=False)
+        bloom, marks, duplicates = self.filters[identifier]
+
+        if position <= marks.get(shard_id, -1):
+            return position in duplicates.get(shard_id, ())
+        marks[shard_id] = position
+        if not bloom.add(data):
+            return False
+        positions = duplicates.setdefault(shard_id, OrderedDict())
+        positions[position] = None
+        if len(positions) > self.max_replays:
+            positions.popitem(last=False)
+        return True
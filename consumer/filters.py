@@ -0,0 +1,84 @@
+import logging
+import os
+from functools import lru_cache
+
+import jsoncodec
+from frames import epoch_ms
+from severity import LEVELS
+
+try:
+    import re2
+except ImportError:  # optional, regex filters pass no line without it
+    re2 = None
+
+log = logging.getLogger()
+
+# Number of distinct filters kept compiled
+FILTER_CACHE_SIZE = int(os.environ.get("FILTER_CACHE_SIZE", 256))
+
+# Client regexes run with RE2, in time linear in the line, and only on its
+# first FILTER_REGEX_SPAN characters: a backtracking engine would let one
+# subscriber stall the fan-out of all the others
+FILTER_REGEX_SPAN = int(os.environ.get("FILTER_REGEX_SPAN", 1024))
+
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def compile_filter(spec_text):
+    """
+    Compile the filter spec a connection set in streamLogs (stored by the
+    registrar in canonical JSON, see registrar._filter_spec) into a
+    predicate on normalized log items, None when there is no filter. Specs
+    are cached by their text, so connections with the same filter share one
+    predicate.
+
+    A filter fails closed: a regex that cannot be compiled (or RE2 missing)
+    passes no line, on top of the other checks, and so does a spec that
+    cannot be read at all.
+
+    A level filter passes its level and above (see severity.LEVELS). Lines
+    without a level or a parseable time pass the level and time checks.
+    """
+    if not spec_text:
+        return None
+    try:
+        spec = jsoncodec.loads(spec_text)
+        checks = []
+        if "stream" in spec:
+            streams = frozenset(spec["stream"])
+            checks.append(lambda item: item.get("stream") in streams)
+        if "level" in spec:
+            allowed = frozenset(LEVELS[LEVELS.index(spec["level"]) :]) | {None}
+            checks.append(lambda item: item.get("level") in allowed)
+        if "contains" in spec:
+            needle = spec["contains"]
+            checks.append(lambda item: needle in item.get("log", ""))
+        if "regex" in spec:
+            checks.append(_regex_check(spec["regex"], spec_text))
+        if "since" in spec:
+            floor = int(spec["since"])
+            checks.append(lambda item: (epoch_ms(item.get("time")) or floor) >= floor)
+    except Exception as e:
+        log.error("Invalid filter %s, passing no line: %s", spec_text, str(e))
+        return _reject
+
+    if not checks:
+        return None
+    if len(checks) == 1:
+        return checks[0]
+    return lambda item: all(check(item) for check in checks)
+
+
+def _regex_check(pattern, spec_text):
+    """The regex check of a filter, one rejecting every line when RE2 cannot run it."""
+    try:
+        if re2 is None:
+            raise ValueError("re2 is not installed")
+        search = re2.compile(pattern).search
+    except Exception as e:
+        log.error("Regex of filter %s passes no line: %s", spec_text, str(e))
+        return _reject
+    return lambda item: search(item.get("log", "")[:FILTER_REGEX_SPAN]) is not None
+
+
+def _reject(item):
+    return False
@@ -0,0 +1,201 @@
+import gzip
+import os
+import re
+import zlib
+from datetime import datetime
+
+import jsoncodec
+
+try:
+    import zstandard
+except ImportError:  # optional, only used when bundled with the Lambda
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:  # optional, frames fall back to JSON without it
+    msgpack = None
+
+# API Gateway rejects WebSocket messages above 128 KB
+MAX_FRAME_BYTES = int(os.environ.get("MAX_FRAME_BYTES", 128 * 1024))
+
+# Appended to a log line that was cut to fit into a frame
+TRUNCATION_MARKER = " …[truncated]"
+
+# Compressed frames are sent as binary: FRAME_MAGIC, one codec id byte, then
+# the compressed payload. Plain JSON and MessagePack frames (an array or a
+# map) never start with FRAME_MAGIC.
+FRAME_MAGIC = 0xA5
+CODECS = {
+    "deflate": (1, zlib.compress),
+    "gzip": (2, lambda data: gzip.compress(data, mtime=0)),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (3, zstandard.ZstdCompressor().compress)
+
+
+# Lines of a columnar frame carry their time as epoch milliseconds
+ISO_TIME = re.compile(
+    r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$"
+)
+
+
+def pack_frames(entries, max_bytes=MAX_FRAME_BYTES, fmt=None, encoding=None):
+    """
+    Pack processed log items into frames of at most max_bytes, yielding
+    (frame, count) pairs where count is the number of entries in the frame.
+
+    entries is a sequence of (item, handle) pairs, where handle identifies the
+    Kinesis record ({"shardId", "sequenceNumber"}) so that a client can fetch
+    the full line when it had to be truncated. Batches are only split at
+    record boundaries. Frames are arrays of items unless fmt is "columnar"
+    (see to_columnar), serialized as MessagePack when encoding is "msgpack"
+    and the package is available, and as JSON otherwise.
+    """
+    binary = encoding == "msgpack" and msgpack is not None
+    dumps = msgpack.packb if binary else jsoncodec.dumps
+    # A MessagePack array is a header of at most 5 bytes and the packed items,
+    # a JSON array is "[" + "]" with "," between the items
+    overhead, separator = (5, 0) if binary else (2, 1)
+
+    items, frame, size = [], [], overhead
+    for item, handle in entries:
+        encoded = dumps(item)
+        if len(encoded) + overhead > max_bytes:
+            item, encoded = _truncate(item, handle, max_bytes - overhead, dumps)
+
+        extra = len(encoded) + (separator if frame else 0)
+        if frame and size + extra > max_bytes:
+            yield _shape(items, frame, fmt, binary), len(items)
+            items, frame, size, extra = [], [], overhead, len(encoded)
+
+        items.append(item)
+        frame.append(encoded)
+        size += extra
+
+    if frame:
+        yield _shape(items, frame, fmt, binary), len(items)
+
+
+def _shape(items, encoded, fmt, binary):
+    """
+    Build the frame for one packed group of already encoded items. A columnar
+    frame is only used when it is smaller than the plain array (not the case
+    for a single line or very heterogeneous items), so it always fits the
+    budget too.
+    """
+    if binary:
+        frame = msgpack.Packer().pack_array_header(len(encoded)) + b"".join(encoded)
+        dumps = msgpack.packb
+    else:
+        frame = b"[" + b",".join(encoded) + b"]"
+        dumps = jsoncodec.dumps
+
+    if fmt == "columnar":
+        columnar = dumps(to_columnar(items))
+        if len(columnar) < len(frame):
+            return columnar
+    return frame
+
+
+def to_columnar(items):
+    """
+    Turn a list of log items into a columnar frame:
+
+        {"count": n, "fields": [...], "values": [[...], ...], "const": {...},
+         "time": [...]}
+
+    Field names are sent once; "values" holds one array per varying field,
+    parallel to the lines (null where a line lacks the field), and "const"
+    the fields that have the same value on every line. When every line has
+    an ISO-8601 time, "time" is removed from the fields and sent as epoch
+    milliseconds, the first absolute and the rest as deltas to the previous
+    line.
+    """
+    times = [epoch_ms(item.get("time")) for item in items]
+    delta = None not in times
+
+    fields = {}
+    for item in items:
+        fields.update(dict.fromkeys(item))
+    if delta:
+        fields.pop("time", None)
+
+    frame = {"count": len(items), "fields": [], "values": [], "const": {}}
+    for field in fields:
+        column = [item.get(field) for item in items]
+        if all(
+            field in item and value == column[0] for item, value in zip(items, column)
+        ):
+            frame["const"][field] = column[0]
+        else:
+            frame["fields"].append(field)
+            frame["values"].append(column)
+    if delta:
+        frame["time"] = times[:1] + [b - a for a, b in zip(times, times[1:])]
+    return frame
+
+
+def epoch_ms(value):
+    """Parse an ISO-8601 time into epoch milliseconds, None if it is not one."""
+    match = ISO_TIME.match(value) if isinstance(value, str) else None
+    if not match:
+        return None
+    base, fraction, zone = match.groups()
+    try:
+        parsed = datetime.fromisoformat(
+            base + "." + (fraction or "0")[:6].ljust(6, "0") + _zone(zone)
+        )
+    except ValueError:
+        return None
+    return round(parsed.timestamp() * 1000)
+
+
+def _zone(zone):
+    """Times without an offset are taken to be UTC."""
+    return "+00:00" if not zone or zone == "Z" else zone
+
+
+def _truncate(item, handle, max_bytes, dumps):
+    """
+    Cut the log line of an item so that its encoding fits into max_bytes,
+    marking it as truncated and attaching the fetch handle.
+    """
+    text = item.get("log", "")
+    if not isinstance(text, str):
+        text = str(text)
+    raw = text.encode()
+
+    truncated = dict(item)
+    truncated["truncated"] = {"bytes": len(raw), **(handle or {})}
+
+    truncated["log"] = TRUNCATION_MARKER
+    overhead = len(dumps(truncated))
+    available = max_bytes - overhead
+
+    # Escaping can grow the line, so shrink it in proportion until it fits
+    keep = max(0, available)
+    while True:
+        truncated["log"] = raw[:keep].decode("utf-8", "ignore") + TRUNCATION_MARKER
+        encoded = dumps(truncated)
+        if len(encoded) <= max_bytes or keep == 0:
+            return truncated, encoded
+        keep = min(keep - 1, keep * available // (len(encoded) - overhead))
+
+
+def encode_message(value, encoding=None):
+    """Serialize a control message (not a log frame) with the frame encoding."""
+    if encoding == "msgpack" and msgpack is not None:
+        return msgpack.packb(value)
+    return jsoncodec.dumps(value)
+
+
+def encode_frame(frame, codec=None):
+    """
+    Compress a packed frame with the codec negotiated by the connection.
+    Unknown or unavailable codecs leave the frame uncompressed.
+    """
+    if codec not in CODECS:
+        return frame
+    codec_id, compress = CODECS[codec]
+    return bytes((FRAME_MAGIC, codec_id)) + compress(frame)
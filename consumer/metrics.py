@@ -0,0 +1,33 @@
+import json
+import os
+import time
+
+# CloudWatch namespace of the consumer metrics
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "InferlessLogSockets")
+
+
+def emit(values: dict, unit="Count", **dimensions):
+    """
+    Publish metrics in CloudWatch Embedded Metric Format: a JSON line on
+    stdout that CloudWatch Logs turns into metrics, without any API call.
+    """
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": NAMESPACE,
+                            "Dimensions": [list(dimensions)],
+                            "Metrics": [
+                                {"Name": name, "Unit": unit} for name in values
+                            ],
+                        }
+                    ],
+                },
+                **dimensions,
+                **values,
+            }
+        )
+    )
@@ -0,0 +1,153 @@
+import logging
+import os
+import re
+from collections import defaultdict
+from functools import lru_cache, partial
+from time import perf_counter
+
+import jsoncodec
+import rules
+from severity import classify
+
+log = logging.getLogger()
+
+# Number of identifiers whose strip pattern is kept compiled
+IDENTIFIER_PATTERN_CACHE = int(os.environ.get("IDENTIFIER_PATTERN_CACHE", 1024))
+
+# A 32-character hex identifier followed by a dash, as a word or anywhere
+HEX_ID_WORD = re.compile(r"(?:\s|^)([a-f0-9]{32})\s*-\s*")
+HEX_ID = re.compile(r"([a-f0-9]{32})\s*-\s*")
+LEADING_DASHES = re.compile(r"^[\s-]+")
+
+
+# Normalizer of each producer logType, records of other types are normalized
+# as build logs. Extended or overridden by LOG_TYPES, a JSON object.
+LOG_TYPES = {
+    "buildLogs": "BUILD",
+    "inferenceLogs": "INFERENCE",
+    "runtimeLogs": "RUNTIME",
+    **jsoncodec.loads(os.environ.get("LOG_TYPES", "{}")),
+}
+DEFAULT_LOG_TYPE = "BUILD"
+
+# Lines normalized by normalize_record and the time it took, per log type:
+# log type -> [lines, seconds]
+STATS = defaultdict(lambda: [0, 0.0])
+
+
+def normalize(log_item, type="BUILD", ignore=False, untag=True):
+    """
+    Turn a decoded producer record into the log item sent to clients: time
+    and stream filled in, the log prefix (the strip rules of type) and, with
+    untag, the "<identifier> - " tag stripped, and the log emptied when the
+    line is not to be shown. The item is returned unchanged when it cannot
+    be normalized.
+    """
+    try:
+        return _normalize(log_item, type, ignore, untag)
+    except Exception as e:
+        log.error("Error normalizing log item: %s", str(e))
+        return log_item
+
+
+# Build logs carry "[...]" / glog prefixes and the identifier tag, inference
+# logs only glog prefixes, and runtime logs are sent as they come
+NORMALIZERS = {
+    "BUILD": partial(normalize, type="BUILD"),
+    "INFERENCE": partial(normalize, type="INFERENCE"),
+    "RUNTIME": partial(normalize, type="RUNTIME", untag=False),
+}
+
+
+def normalize_record(log_item):
+    """
+    Normalize a record with the normalizer of its logType and tag the lines
+    to be shown with their level, timing both.
+    """
+    log_type = LOG_TYPES.get(log_item.get("logType"), DEFAULT_LOG_TYPE)
+    started = perf_counter()
+    item = NORMALIZERS.get(log_type, NORMALIZERS[DEFAULT_LOG_TYPE])(log_item)
+    if item is not log_item and item.get("log"):
+        item["level"] = classify(item, log_type)
+    stats = STATS[log_type]
+    stats[0] += 1
+    stats[1] += perf_counter() - started
+    return item
+
+
+def take_stats():
+    """The per log type [lines, seconds] since the last call."""
+    stats = dict(STATS)
+    STATS.clear()
+    return stats
+
+
+def _normalize(log_item, type, ignore, untag):
+    if isinstance(log_item, dict):
+        record, item = log_item, dict(log_item)
+    else:
+        # Only the known fields are kept from records given as JSON text
+        record, item = jsoncodec.loads(log_item), {}
+
+    if "time" in record:
+        item["time"] = record["time"]
+    else:
+        item["time"] = record.get("@timestamp", "unknown")
+
+    content = record.get("log", "")
+    if not content and "message" in record:
+        content = record.get("message", "")
+    if not isinstance(content, str):
+        raise TypeError("log is not a string")
+
+    item["stream"] = record.get("stream", "stdout")
+    if "identifierId" in record:
+        item["identifierId"] = record["identifierId"]
+
+    text = rules.ACTIVE.strip(content, type).strip()
+    if rules.ACTIVE.drops(content, text, type, ignore):
+        text = ""
+    if text and untag:
+        text = _strip_identifier(text, _identifier(record))
+    item["log"] = text
+    return item
+
+
+def _identifier(record):
+    identifier = record.get("identifierId")
+    if isinstance(identifier, list):
+        return identifier[0] if identifier else None
+    return identifier if isinstance(identifier, str) else None
+
+
+def _strip_identifier(text, identifier):
+    """
+    Remove the "<identifier> - " tag from a stripped, non-empty line. Each
+    pattern is only tried when the line can contain a match.
+    """
+    if identifier:
+        if text.startswith(identifier):
+            rest = text[len(identifier) :].lstrip()
+            if rest.startswith("- "):
+                text = rest[2:].strip()
+        if identifier in text:
+            text = _identifier_pattern(identifier).sub(" ", text, count=1).strip()
+
+    # Then the tag of any other hex identifier
+    if "-" in text and HEX_ID.search(text):
+        text = HEX_ID_WORD.sub(" ", text, count=1).strip()
+        text = HEX_ID.sub("", text, count=1).strip()
+
+    if identifier and identifier in text:
+        parts = text.split(identifier + " - ", 1)
+        if len(parts) > 1:
+            text = parts[1].strip()
+
+    if text.startswith("-"):
+        text = LEADING_DASHES.sub("", text, count=1).strip()
+    return text
+
+
+@lru_cache(maxsize=IDENTIFIER_PATTERN_CACHE)
+def _identifier_pattern(identifier):
+    return re.compile(r"(?:\s|^)" + re.escape(identifier) + r"\s*-\s*")
@@ -0,0 +1,53 @@
+from datetime import datetime, timezone
+from time import monotonic
+
+
+class TokenBucket:
+    """
+    Line budget of one connection: up to burst lines at once, refilled at
+    rate lines per second. Lines over the budget are counted as suppressed,
+    with the time of the first one, until reported.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.suppressed = 0
+        self.since = None
+        self.reported = monotonic()
+
+    def configure(self, rate, burst):
+        if (rate, burst) != (self.rate, self.burst):
+            self.rate, self.burst = rate, burst
+            self.tokens = min(self.tokens, float(burst))
+
+    def take(self, count):
+        """Take up to count lines from the budget, returning how many were granted."""
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        granted = min(count, int(self.tokens))
+        self.tokens -= granted
+        if granted < count:
+            if not self.suppressed:
+                self.since = (
+                    datetime.now(timezone.utc)
+                    .isoformat(timespec="milliseconds")
+                    .replace("+00:00", "Z")
+                )
+            self.suppressed += count - granted
+        return granted
+
+    def summary(self, interval):
+        """
+        The {"suppressed": N, "since": ...} summary to send, at most every
+        interval seconds, None when there is nothing (yet) to report.
+        """
+        if not self.suppressed or monotonic() - self.reported < interval:
+            return None
+        summary = {"suppressed": self.suppressed, "since": self.since}
+        self.suppressed, self.since, self.reported = 0, None, monotonic()
+        return summary
@@ -0,0 +1,316 @@
+import logging
+import os
+import re
+from collections import Counter
+from time import monotonic
+
+import boto3
+
+import jsoncodec
+
+try:
+    import ahocorasick
+except ImportError:  # optional, literals are matched by the regex without it
+    ahocorasick = None
+
+log = logging.getLogger()
+
+# Where the drop and strip rules come from, first one set wins: an item of the
+# connections table (its "rules" attribute, a JSON string), a JSON file, or
+# the LOG_RULES variable. The item and the file are reloaded when they
+# change, checked at most every LOG_RULES_RELOAD_SECONDS.
+LOG_RULES_ITEM = os.environ.get("LOG_RULES_ITEM")
+LOG_RULES_FILE = os.environ.get("LOG_RULES_FILE")
+LOG_RULES_RELOAD_SECONDS = int(os.environ.get("LOG_RULES_RELOAD_SECONDS", 60))
+
+# The rules built into the consumer. A rule is
+#
+#     {"name": ..., "action": "drop" | "strip",
+#      "match": "literal" | "prefix" | "regex" | "line", "pattern": ...,
+#      "ignoreCase": false, "types": [...]}
+#
+# Strip rules remove a prefix ("prefix") or a leading regex match ("regex")
+# from the line, in order. Drop rules empty the line when it contains a
+# literal, starts with a prefix or matches a regex, all checked after
+# stripping, or when the line as sent is exactly "line". Rules only apply
+# to the log types in "types", to all of them when it is missing.
+DEFAULT_RULES = [
+    {
+        "name": "bracket-prefix",
+        "action": "strip",
+        "match": "regex",
+        "pattern": r"\[.*?\]",
+        "types": ["BUILD"],
+    },
+    {
+        "name": "glog-prefix",
+        "action": "strip",
+        "match": "regex",
+        "pattern": r"I.*?\]",
+        "types": ["BUILD", "INFERENCE"],
+    },
+    {
+        "name": "serving-stack",
+        "action": "drop",
+        "match": "regex",
+        "pattern": "nvidia|triton",
+        "ignoreCase": True,
+    },
+    {
+        "name": "license-banner",
+        "action": "drop",
+        "match": "line",
+        "pattern": "By pulling and using the container, you accept the terms and conditions of this license:",
+    },
+]
+
+MATCHES = {
+    "drop": ("literal", "prefix", "regex", "line"),
+    "strip": ("prefix", "regex"),
+}
+
+# Escapes, named groups and conditionals of a rule's regex. Named groups and
+# group references (\1, (?P=name), (?(1)...)) are refused: once the rules
+# are combined into one regex, the names could clash and the numbers shift.
+_GROUP_SYNTAX = re.compile(r"\\.|\(\?P[<=]|\(\?\(")
+
+
+class RuleSet:
+    """
+    Drop and strip rules compiled, per log type, into one strip regex and one
+    drop matcher, so that each line is scanned once whatever the number of
+    rules. hits counts the lines each rule stripped or dropped.
+
+    The matchers of all log types are compiled up front, so that rules that
+    cannot be combined fail here rather than on every line.
+    """
+
+    def __init__(self, rules):
+        self.rules = [rule for rule in rules if _valid(rule)]
+        # Log types named by a rule -> their matchers, the types no rule
+        # names sharing the matchers of the rules for all types
+        types = {type for rule in self.rules for type in rule.get("types", [])}
+        self.compiled = {
+            type: _TypeRules(
+                [rule for rule in self.rules if type in rule.get("types", [type])]
+            )
+            for type in types
+        }
+        self.default = _TypeRules([rule for rule in self.rules if "types" not in rule])
+        self.hits = Counter()
+
+    def strip(self, text, type):
+        rules = self._for_type(type)
+        if rules.strip is None:
+            return text
+        match = rules.strip.match(text)
+        if not match.end():
+            return text
+        for group, name in rules.strip_names.items():
+            if match.group(group):
+                self.hits[name] += 1
+        return text[match.end() :]
+
+    def drops(self, line, text, type, ignore=False):
+        """
+        True when a rule drops the line, given as sent (line) and stripped
+        (text). With ignore, only the "line" rules are checked.
+        """
+        rules = self._for_type(type)
+        name = rules.lines.get(line)
+        if name is None and not ignore:
+            name = rules.match(text)
+        if name is None:
+            return False
+        self.hits[name] += 1
+        return True
+
+    def take_hits(self):
+        hits, self.hits = self.hits, Counter()
+        return hits
+
+    def _for_type(self, type):
+        return self.compiled.get(type, self.default)
+
+
+class _TypeRules:
+    def __init__(self, rules):
+        strips = [rule for rule in rules if rule["action"] == "strip"]
+        drops = [rule for rule in rules if rule["action"] == "drop"]
+
+        # Strip rules are tried in order, each one at most once
+        self.strip_names = {}
+        parts = []
+        for rule in strips:
+            group = "s%d" % len(parts)
+            self.strip_names[group] = rule["name"]
+            parts.append("(?:(?P<%s>%s))?" % (group, _pattern(rule)))
+        self.strip = re.compile("^" + "".join(parts)) if parts else None
+
+        self.lines = {
+            rule["pattern"]: rule["name"]
+            for rule in reversed(drops)
+            if rule["match"] == "line"
+        }
+        self.prefixes = {
+            rule["pattern"]: rule["name"]
+            for rule in reversed(drops)
+            if rule["match"] == "prefix" and not rule.get("ignoreCase")
+        }
+        self.prefix_tuple = tuple(self.prefixes)
+
+        # Case-sensitive literals go to the automaton when there is one,
+        # everything else into a single alternation
+        self.automaton = None
+        literals = [
+            rule
+            for rule in drops
+            if rule["match"] == "literal" and not rule.get("ignoreCase")
+        ]
+        if ahocorasick is not None and literals:
+            self.automaton = ahocorasick.Automaton()
+            for rule in reversed(literals):
+                self.automaton.add_word(rule["pattern"], rule["name"])
+            self.automaton.make_automaton()
+        patterns = [
+            rule
+            for rule in drops
+            if rule["match"] != "line"
+            and not (rule["match"] == "prefix" and not rule.get("ignoreCase"))
+            and not (self.automaton is not None and rule in literals)
+        ]
+        self.drop_names = {"d%d" % i: rule["name"] for i, rule in enumerate(patterns)}
+        # The alternation is searched, so prefixes are anchored at the start
+        self.drop = (
+            re.compile(
+                "|".join(
+                    "(?P<d%d>%s%s)"
+                    % (i, r"\A" if rule["match"] == "prefix" else "", _pattern(rule))
+                    for i, rule in enumerate(patterns)
+                )
+            )
+            if patterns
+            else None
+        )
+
+    def match(self, text):
+        """Name of the first drop rule matching a stripped line, None if none does."""
+        if self.prefix_tuple and text.startswith(self.prefix_tuple):
+            for prefix, name in self.prefixes.items():
+                if text.startswith(prefix):
+                    return name
+        if self.automaton is not None:
+            for _, name in self.automaton.iter(text):
+                return name
+        if self.drop is not None:
+            match = self.drop.search(text)
+            if match:
+                for group, name in self.drop_names.items():
+                    if match.group(group) is not None:
+                        return name
+        return None
+
+
+def _pattern(rule):
+    """The regex of a rule, anchored by the caller."""
+    if rule["match"] == "regex":
+        pattern = "(?:%s)" % rule["pattern"]
+    else:
+        pattern = re.escape(rule["pattern"])
+    return "(?i:%s)" % pattern if rule.get("ignoreCase") else pattern
+
+
+def _valid(rule):
+    try:
+        if not isinstance(rule.get("name"), str) or not isinstance(
+            rule.get("pattern"), str
+        ):
+            raise ValueError("name and pattern must be strings")
+        if rule.get("match") not in MATCHES.get(rule.get("action"), ()):
+            raise ValueError("unsupported action or match")
+        if not isinstance(rule.get("types", []), list):
+            raise ValueError("types must be a list")
+        if rule["match"] == "regex":
+            for syntax in _GROUP_SYNTAX.finditer(rule["pattern"]):
+                token = syntax.group()
+                if not token.startswith("\\") or token[1] in "123456789":
+                    raise ValueError(
+                        "named groups and group references are not supported"
+                    )
+        re.compile(_pattern(rule))
+    except Exception as e:
+        log.error("Ignoring log rule %s: %s", rule, str(e))
+        return False
+    return True
+
+
+def _load():
+    """
+    Read the configured rules, returning (version, rules) where version
+    changes whenever the source does.
+    """
+    if LOG_RULES_ITEM:
+        item = (
+            boto3.client("dynamodb")
+            .get_item(
+                TableName=os.environ["TABLE"],
+                Key={"PK": {"S": LOG_RULES_ITEM}},
+                ProjectionExpression="#r",
+                ExpressionAttributeNames={"#r": "rules"},
+            )
+            .get("Item", {})
+        )
+        text = item.get("rules", {}).get("S")
+    elif LOG_RULES_FILE:
+        with open(LOG_RULES_FILE, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = os.environ.get("LOG_RULES")
+    if not text:
+        return None, DEFAULT_RULES
+
+    rules = jsoncodec.loads(text)
+    if not isinstance(rules, list):
+        raise ValueError("log rules must be a JSON list")
+    return text, rules
+
+
+# The rules in force, the version of their source and when it was checked.
+# The built-in rules apply until the configured ones are first loaded.
+_UNLOADED = object()
+ACTIVE = RuleSet(DEFAULT_RULES)
+version, _checked = _UNLOADED, None
+
+
+def refresh(force=False):
+    """
+    Reload the rules if their source changed, at most every
+    LOG_RULES_RELOAD_SECONDS unless forced. The current rules stay in force
+    when the new ones cannot be read.
+    """
+    global ACTIVE, version, _checked
+    if (
+        not force
+        and _checked is not None
+        and monotonic() - _checked < LOG_RULES_RELOAD_SECONDS
+    ):
+        return
+    _checked = monotonic()
+    try:
+        new_version, rules = _load()
+    except Exception as e:
+        log.error("Could not reload log rules: %s", str(e))
+        return
+    if new_version != version:
+        try:
+            rules = RuleSet(rules)
+        except Exception as e:
+            log.error("Could not compile log rules: %s", str(e))
+            return
+        log.info("Reloaded %d log rules", len(rules.rules))
+        hits = ACTIVE.take_hits()
+        version, ACTIVE = new_version, rules
+        ACTIVE.hits.update(hits)
+
+
+refresh(force=True)
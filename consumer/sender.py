@@ -0,0 +1,286 @@
+import logging
+import os
+import random
+from collections import deque
+from time import monotonic, sleep
+
+from botocore.exceptions import ClientError
+
+log = logging.getLogger()
+
+# Management API errors worth retrying after a pause
+THROTTLE_CODES = {
+    "LimitExceededException",
+    "TooManyRequestsException",
+    "ThrottlingException",
+    "Throttling",
+}
+
+# Exponential backoff with full jitter: attempt n waits up to
+# min(cap, base * 2**n), and a frame is given up after SEND_MAX_ATTEMPTS or
+# when the wait would run past the deadline
+SEND_BACKOFF_BASE = int(os.environ.get("SEND_BACKOFF_BASE_MS", 50)) / 1000
+SEND_BACKOFF_CAP = int(os.environ.get("SEND_BACKOFF_CAP_MS", 2000)) / 1000
+SEND_MAX_ATTEMPTS = int(os.environ.get("SEND_MAX_ATTEMPTS", 8))
+
+# Deficit round-robin across flows (see Sender): bytes a flow may send per
+# round
+SCHEDULER_QUANTUM = int(os.environ.get("SCHEDULER_QUANTUM_BYTES", 32 * 1024))
+
+# Lanes of a connection's queue, in the order they are sent: urgent frames
+# (stderr and error lines) go ahead of the others. Within SEND_URGENT_WINDOW_MS
+# of running out of time, only connections with urgent frames are served.
+LANES = ("urgent", "normal")
+SEND_URGENT_WINDOW = int(os.environ.get("SEND_URGENT_WINDOW_MS", 3000)) / 1000
+
+# Smoothed send latency per connection, in seconds: connectionId -> EWMA.
+# A throttled connection waits at least that long before the next attempt
+# (see retry_wait), so that slow endpoints are paced rather than retried
+# into giving up.
+LATENCY: dict[str, float] = {}
+LATENCY_WEIGHT = 0.2
+
+
+def is_retryable(e):
+    """Throttling and server-side errors of the management API."""
+    if not isinstance(e, ClientError):
+        return False
+    error = e.response.get("Error", {})
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return error.get("Code") in THROTTLE_CODES or status == 429 or status >= 500
+
+
+def backoff(attempt):
+    return random.uniform(0, min(SEND_BACKOFF_CAP, SEND_BACKOFF_BASE * 2**attempt))
+
+
+def retry_wait(cid, attempt):
+    """Backoff before retrying a throttled connection, at least its LATENCY."""
+    return max(backoff(attempt), LATENCY.get(cid, 0))
+
+
+class Sender:
+    """
+    Send layer of the fan-out: one queue of frames per connection, so that a
+    throttled connection waits out its backoff while the others keep
+    sending. Each queue has a lane per LANES.
+
+    Connections are grouped into flows (e.g. the identifiers they watch),
+    served by deficit round-robin: each round a flow may send
+    SCHEDULER_QUANTUM bytes, spread round-robin over its connections. A
+    flow with many lines or watchers thus gets the same share of the
+    batch as a quiet one instead of delaying it.
+
+    post(cid, data) sends a frame, is_gone(e) tells whether an error means
+    the connection is gone, and time_left() gives the seconds left before
+    the invocation has to stop sending (None when there is no deadline).
+    """
+
+    def __init__(self, post, is_gone, time_left, on_gone, started=None):
+        self.post = post
+        self.is_gone = is_gone
+        self.time_left = time_left
+        self.on_gone = on_gone
+        self.started = monotonic() if started is None else started
+        # connectionId -> lane -> deque of [data, on_sent, on_failed, attempts]
+        self.queues: dict[str, dict] = {}
+        # Number of urgent frames queued
+        self.urgent = 0
+        self.retry_at: dict[str, float] = {}
+        # flow -> deque of its connectionIds
+        self.flows: dict[object, deque] = {}
+        self.throttled = 0
+        # Duration of each post, and time from start to each delivery per
+        # lane
+        self.latencies: list[float] = []
+        self.delays: dict[str, list] = {lane: [] for lane in LANES}
+
+    def enqueue(
+        self, cid, data, on_sent=None, on_failed=None, flow=None, lane="normal"
+    ):
+        """
+        Queue a frame. on_sent is called once it is delivered, on_failed
+        when it is given up for a reason worth retrying (throttling, server
+        errors, no time left), not when the connection is gone or rejects
+        it. A connection
+        stays in the flow of its first frame, its own by default.
+        """
+        if cid not in self.queues:
+            self.queues[cid] = {lane: deque() for lane in LANES}
+            self.flows.setdefault(cid if flow is None else flow, deque()).append(cid)
+        self.queues[cid][lane].append([data, on_sent, on_failed, 0])
+        if lane == "urgent":
+            self.urgent += 1
+
+    def flush(self):
+        """Send every queued frame, or give it up, before returning."""
+        deficits = dict.fromkeys(self.flows, 0)
+        while self.queues:
+            urgent_only = self._pressed()
+            progressed = False
+            for flow in list(self.flows):
+                members = self.flows[flow]
+                for _ in range(len(members)):
+                    if members[0] not in self.queues:
+                        members.popleft()
+                    else:
+                        members.rotate(-1)
+                if not members:
+                    del self.flows[flow]
+                    continue
+
+                deficits[flow] += SCHEDULER_QUANTUM
+                if deficits[flow] <= 0:
+                    # Still paying off a frame larger than the quantum
+                    progressed = True
+                    continue
+                while deficits[flow] > 0:
+                    left = self.time_left()
+                    if left is not None and left <= 0:
+                        self._fail_all()
+                        return
+                    cid = self._next_ready(members, urgent_only)
+                    if cid is None:
+                        break
+                    deficits[flow] -= len(self._head(cid)[1][0])
+                    self._send_head(cid)
+                    progressed = True
+                # Unused credit is only kept while the flow is held up by
+                # throttling, and then for one round at most
+                if not any(cid in self.queues for cid in members):
+                    deficits[flow] = 0
+                deficits[flow] = min(deficits[flow], SCHEDULER_QUANTUM)
+
+            if progressed or not self.queues:
+                continue
+            wait = (
+                min(
+                    self.retry_at.get(cid, 0)
+                    for cid, lanes in self.queues.items()
+                    if lanes["urgent"] or not urgent_only
+                )
+                - monotonic()
+            )
+            if not self._can_wait(wait):
+                self._fail_all()
+                return
+            sleep(max(0, wait))
+
+    def _next_ready(self, members, urgent_only=False):
+        """
+        The next connection of a flow whose backoff is over (and which has
+        urgent frames, with urgent_only), rotating the flow.
+        """
+        now = monotonic()
+        for _ in range(len(members)):
+            cid = members[0]
+            members.rotate(-1)
+            if (
+                cid in self.queues
+                and self.retry_at.get(cid, 0) <= now
+                and (self.queues[cid]["urgent"] or not urgent_only)
+            ):
+                return cid
+        return None
+
+    def _pressed(self):
+        """True when urgent frames are queued and time is about to run out."""
+        if not self.urgent:
+            return False
+        left = self.time_left()
+        return left is not None and left < SEND_URGENT_WINDOW
+
+    def _head(self, cid):
+        """(lane, entry) of the next frame of a connection."""
+        for lane, queue in self.queues[cid].items():
+            if queue:
+                return lane, queue[0]
+        raise KeyError(cid)
+
+    def post_now(self, cid, data):
+        """
+        Send one frame right away, retrying it the same way as queued
+        frames, and raise the last error when it is given up.
+        """
+        for attempt in range(SEND_MAX_ATTEMPTS):
+            try:
+                return self._timed_post(cid, data)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                self.throttled += 1
+                wait = retry_wait(cid, attempt)
+                if attempt + 1 == SEND_MAX_ATTEMPTS or not self._can_wait(wait):
+                    raise
+                sleep(wait)
+
+    def _send_head(self, cid):
+        lane, entry = self._head(cid)
+        data, on_sent, on_failed, attempts = entry
+        try:
+            self._timed_post(cid, data)
+        except Exception as e:
+            if self.is_gone(e):
+                log.warning("Connection %s gone, dropping its queue", cid)
+                self._drop(cid)
+                self.on_gone(cid)
+                return
+            if is_retryable(e) and attempts + 1 < SEND_MAX_ATTEMPTS:
+                self.throttled += 1
+                entry[3] = attempts + 1
+                self.retry_at[cid] = monotonic() + retry_wait(cid, attempts)
+                return
+            if is_retryable(e):
+                log.error("Giving up sending logs to %s: %s", cid, str(e))
+                # Later frames must not overtake the failed one
+                self._fail(cid)
+                return
+            # Client errors (forbidden, payload too large, ...) would fail
+            # again on retry: the frame is dropped
+            log.error("Dropping frame for %s: %s", cid, str(e))
+            self._pop_head(cid, lane)
+            return
+
+        self._pop_head(cid, lane)
+        self.delays[lane].append(monotonic() - self.started)
+        if on_sent:
+            on_sent()
+
+    def _pop_head(self, cid, lane):
+        self.queues[cid][lane].popleft()
+        if lane == "urgent":
+            self.urgent -= 1
+        self.retry_at.pop(cid, None)
+        if not any(self.queues[cid].values()):
+            self._drop(cid)
+
+    def _timed_post(self, cid, data):
+        started = monotonic()
+        self.post(cid, data)
+        latency = monotonic() - started
+        self.latencies.append(latency)
+        previous = LATENCY.get(cid, latency)
+        LATENCY[cid] = previous + LATENCY_WEIGHT * (latency - previous)
+
+    def _can_wait(self, wait):
+        left = self.time_left()
+        return left is None or wait < left
+
+    def _fail(self, cid):
+        for _, _, on_failed, _ in self._drop(cid):
+            if on_failed:
+                on_failed()
+
+    def _fail_all(self):
+        log.warning(
+            "Out of time with frames queued for %d connections", len(self.queues)
+        )
+        for cid in list(self.queues):
+            self._fail(cid)
+
+    def _drop(self, cid):
+        """Forget a connection's queue, returning its frames in send order."""
+        self.retry_at.pop(cid, None)
+        lanes = self.queues.pop(cid, {})
+        self.urgent -= len(lanes.get("urgent", ()))
+        return [entry for queue in lanes.values() for entry in queue]
@@ -0,0 +1,406 @@
+import asyncio
+import base64
+import logging
+import os
+import random
+import signal
+import socket
+import uuid
+from time import monotonic, time
+
+from botocore.exceptions import ClientError
+
+from consumer import STREAM, ddb, handler, kinesis
+
+log = logging.getLogger()
+
+# Long-running alternative to the Lambda event source mapping: reads the
+# shards itself, sharing them with the other instances through leases, and
+# hands each page of records to the same decode, normalize and fan-out
+# pipeline as the Lambda (consumer.handler). Back-fills and unsubscribes are
+# still control events of the consumer Lambda (see registrar).
+#
+# The clients honour the usual endpoint variables, so that the service runs
+# against local stand-ins, e.g.
+#
+#     AWS_ENDPOINT_URL_KINESIS=http://localhost:4566 \
+#     AWS_ENDPOINT_URL_DYNAMODB=http://localhost:8000 \
+#     STREAM=model-logs TABLE=ConnectionTable WS_CALLBACK_URL=... \
+#     PYTHONPATH=../shared python service.py
+
+# Shard leases and checkpoints, one item per shard, kept in the connections
+# table unless set. A lease not renewed for LEASE_SECONDS can be taken by
+# another instance. Instances renew their leases and take free ones every
+# LEASE_RENEW_SECONDS, up to MAX_LEASES (0 for no limit).
+LEASE_TABLE = os.environ.get("LEASE_TABLE", os.environ["TABLE"])
+LEASE_SECONDS = int(os.environ.get("LEASE_SECONDS", 30))
+LEASE_RENEW_SECONDS = int(os.environ.get("LEASE_RENEW_SECONDS", 10))
+MAX_LEASES = int(os.environ.get("MAX_LEASES", 0))
+
+# Where a shard without checkpoint is read from, LATEST or TRIM_HORIZON.
+# The children of shards still listed (read to their end first) are always
+# read from TRIM_HORIZON, as records put to them before their lease was
+# taken would be skipped otherwise.
+INITIAL_POSITION = os.environ.get("INITIAL_POSITION", "LATEST")
+
+# Records per GetRecords call, pause once a shard is caught up, and pause
+# before records whose delivery failed are read again
+POLL_LIMIT = int(os.environ.get("POLL_LIMIT", 1000))
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL_SECONDS", 1))
+RETRY_INTERVAL = float(os.environ.get("RETRY_INTERVAL_SECONDS", 5))
+
+# Shortest time between two GetRecords calls on a shard (Kinesis allows 5
+# per second per shard, shared by all its consumers). A throttled call is
+# retried after a jittered exponential backoff of at most READ_BACKOFF_CAP.
+GET_RECORDS_INTERVAL = float(os.environ.get("GET_RECORDS_INTERVAL_SECONDS", 0.2))
+READ_BACKOFF_CAP = float(os.environ.get("READ_BACKOFF_CAP_SECONDS", 10))
+READ_THROTTLE_CODES = {
+    "ProvisionedThroughputExceededException",
+    "KMSThrottlingException",
+}
+
+# Times the records of a page whose delivery failed are read again before
+# they are skipped (checkpointed past), as the MaximumRetryAttempts of an
+# event source mapping; -1 to retry until they are delivered
+MAX_RETRY_ATTEMPTS = int(os.environ.get("MAX_RETRY_ATTEMPTS", 10))
+
+# Checkpoint of a shard read to its end (after a split or merge)
+SHARD_END = "SHARD_END"
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Leases:
+    """
+    Shard leases of one instance, as LEASE_TABLE items
+
+        {"PK": "LEASE#<stream>#<shardId>", "leaseOwner": ...,
+         "expiresAt": <epoch ms>, "checkpoint": <sequence number>}
+
+    Every write is conditional on the owner, so two instances never both
+    hold a lease and a checkpoint is only moved by its holder.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def acquire(self, shard_id):
+        """
+        Take or renew the lease of a shard, returning its checkpoint (None
+        when it has none). Raises LeaseLost when another instance holds it
+        or the shard was read to its end.
+        """
+        now = int(time() * 1000)
+        try:
+            resp = ddb.update_item(
+                TableName=LEASE_TABLE,
+                Key=self._key(shard_id),
+                UpdateExpression="SET leaseOwner = :me, expiresAt = :expires",
+                ConditionExpression="(attribute_not_exists(PK) OR leaseOwner = :me"
+                " OR expiresAt < :now) AND NOT checkpoint = :end",
+                ExpressionAttributeValues={
+                    ":me": {"S": self.owner},
+                    ":expires": {"N": str(now + LEASE_SECONDS * 1000)},
+                    ":now": {"N": str(now)},
+                    ":end": {"S": SHARD_END},
+                },
+                ReturnValues="ALL_NEW",
+            )
+        except ddb.exceptions.ConditionalCheckFailedException:
+            raise LeaseLost(shard_id)
+        return resp["Attributes"].get("checkpoint", {}).get("S")
+
+    def checkpoint(self, shard_id, sequence):
+        try:
+            ddb.update_item(
+                TableName=LEASE_TABLE,
+                Key=self._key(shard_id),
+                UpdateExpression="SET checkpoint = :seq",
+                ConditionExpression="leaseOwner = :me",
+                ExpressionAttributeValues={
+                    ":seq": {"S": sequence},
+                    ":me": {"S": self.owner},
+                },
+            )
+        except ddb.exceptions.ConditionalCheckFailedException:
+            raise LeaseLost(shard_id)
+
+    def checkpoint_of(self, shard_id):
+        """The checkpoint of a shard, whoever holds its lease (None without)."""
+        resp = ddb.get_item(
+            TableName=LEASE_TABLE, Key=self._key(shard_id), ConsistentRead=True
+        )
+        return resp.get("Item", {}).get("checkpoint", {}).get("S")
+
+    def release(self, shard_id):
+        """Let the lease expire now, so that another instance takes it at once."""
+        try:
+            ddb.update_item(
+                TableName=LEASE_TABLE,
+                Key=self._key(shard_id),
+                UpdateExpression="SET expiresAt = :zero",
+                ConditionExpression="leaseOwner = :me",
+                ExpressionAttributeValues={
+                    ":zero": {"N": "0"},
+                    ":me": {"S": self.owner},
+                },
+            )
+        except Exception as e:
+            log.warning("Could not release lease of %s: %s", shard_id, str(e))
+
+    def _key(self, shard_id):
+        return {"PK": {"S": f"LEASE#{STREAM}#{shard_id}"}}
+
+
+class Service:
+    """
+    Reads the shards this instance holds the lease of, one task per shard.
+    Pages are fanned out one at a time, as the fan-out state (watermarks,
+    line budgets, ...) is shared, while other shards keep polling.
+
+    The children of a split or merge are only taken once their parents were
+    read to their end, so that the records of a partition key are sent in
+    order.
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.leases = Leases(self.owner)
+        # shardId -> task reading it
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.fanout = asyncio.Lock()
+        # Shards read to their end, by any instance
+        self.finished: set[str] = set()
+        self.stopping = asyncio.Event()
+
+    async def run(self):
+        log.info("Consumer service %s reading %s", self.owner, STREAM)
+        while not self.stopping.is_set():
+            await self._balance()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), LEASE_RENEW_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        for shard_id in self.tasks:
+            await asyncio.to_thread(self.leases.release, shard_id)
+        log.info("Consumer service %s stopped", self.owner)
+
+    async def _balance(self):
+        """Renew the leases held, drop the lost ones and take free ones."""
+        try:
+            shards = await asyncio.to_thread(_list_shards)
+        except Exception as e:
+            log.error("Error listing shards: %s", str(e))
+            return
+
+        for shard_id, task in list(self.tasks.items()):
+            if task.done() or shard_id not in shards:
+                task.cancel()
+                del self.tasks[shard_id]
+
+        for shard_id, parents in shards.items():
+            if shard_id in self.finished:
+                continue
+            held = shard_id in self.tasks
+            if not held and MAX_LEASES and len(self.tasks) >= MAX_LEASES:
+                continue
+            try:
+                if not held and not await self._parents_done(parents, shards):
+                    continue
+            except Exception as e:
+                log.error("Error reading the parents of %s: %s", shard_id, str(e))
+                continue
+            try:
+                checkpoint = await asyncio.to_thread(self.leases.acquire, shard_id)
+            except LeaseLost:
+                if held:
+                    log.warning("Lost the lease of %s", shard_id)
+                    self.tasks.pop(shard_id).cancel()
+                continue
+            except Exception as e:
+                log.error("Error renewing lease of %s: %s", shard_id, str(e))
+                continue
+            if not held:
+                log.info("Took the lease of %s at %s", shard_id, checkpoint)
+                initial = INITIAL_POSITION
+                if any(parent in shards for parent in parents):
+                    initial = "TRIM_HORIZON"
+                self.tasks[shard_id] = asyncio.create_task(
+                    self._consume(shard_id, checkpoint, initial)
+                )
+
+    async def _parents_done(self, parents, shards):
+        """True once the parents of a shard that are still listed were read to their end."""
+        for parent in parents:
+            if parent not in shards or parent in self.finished:
+                continue
+            checkpoint = await asyncio.to_thread(self.leases.checkpoint_of, parent)
+            if checkpoint != SHARD_END:
+                return False
+            self.finished.add(parent)
+        return True
+
+    async def _consume(self, shard_id, checkpoint, initial=INITIAL_POSITION):
+        """Read a shard from its checkpoint on, moving the checkpoint as pages are sent."""
+        # Time of the last GetRecords call, consecutive throttled calls, and
+        # the first record that failed and the times it was read again
+        polled, throttled = 0.0, 0
+        retrying, attempts = None, 0
+        try:
+            iterator = await asyncio.to_thread(
+                _iterator, shard_id, checkpoint, initial=initial
+            )
+            while iterator:
+                await asyncio.sleep(max(0, polled + GET_RECORDS_INTERVAL - monotonic()))
+                polled = monotonic()
+                try:
+                    resp = await asyncio.to_thread(
+                        kinesis.get_records, ShardIterator=iterator, Limit=POLL_LIMIT
+                    )
+                except ClientError as e:
+                    if (
+                        e.response.get("Error", {}).get("Code")
+                        not in READ_THROTTLE_CODES
+                    ):
+                        raise
+                    wait = random.uniform(
+                        0, min(READ_BACKOFF_CAP, GET_RECORDS_INTERVAL * 2**throttled)
+                    )
+                    throttled += 1
+                    log.warning("Reads of %s throttled, waiting %.2fs", shard_id, wait)
+                    await asyncio.sleep(wait)
+                    continue
+                throttled = 0
+                iterator = resp.get("NextShardIterator")
+                records = resp.get("Records", [])
+                if not records:
+                    if not resp.get("MillisBehindLatest"):
+                        await asyncio.sleep(POLL_INTERVAL)
+                    continue
+
+                async with self.fanout:
+                    result = await asyncio.to_thread(
+                        handler, _event(shard_id, records), None
+                    )
+
+                # Failures are sorted: checkpoint what precedes the first one
+                # and read again from there, as the Lambda would
+                failures = result["batchItemFailures"]
+                if failures:
+                    first = int(failures[0]["itemIdentifier"])
+                    attempts = attempts + 1 if first == retrying else 1
+                    retrying = first
+                    if 0 <= MAX_RETRY_ATTEMPTS < attempts:
+                        log.error(
+                            "Giving up %d records of %s from %s after %d retries",
+                            len(failures),
+                            shard_id,
+                            first,
+                            MAX_RETRY_ATTEMPTS,
+                        )
+                        retrying, attempts = None, 0
+                        await asyncio.to_thread(
+                            self.leases.checkpoint,
+                            shard_id,
+                            records[-1]["SequenceNumber"],
+                        )
+                        continue
+                    sent = [
+                        r["SequenceNumber"]
+                        for r in records
+                        if int(r["SequenceNumber"]) < first
+                    ]
+                    if sent:
+                        await asyncio.to_thread(
+                            self.leases.checkpoint, shard_id, sent[-1]
+                        )
+                    await asyncio.sleep(RETRY_INTERVAL)
+                    iterator = await asyncio.to_thread(
+                        _iterator, shard_id, str(first), "AT_SEQUENCE_NUMBER"
+                    )
+                    continue
+
+                await asyncio.to_thread(
+                    self.leases.checkpoint, shard_id, records[-1]["SequenceNumber"]
+                )
+
+            log.info("Read %s to its end", shard_id)
+            await asyncio.to_thread(self.leases.checkpoint, shard_id, SHARD_END)
+            self.finished.add(shard_id)
+        except LeaseLost:
+            log.warning("Lost the lease of %s, stopping", shard_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The lease is renewed but the task is gone: let it expire so
+            # that this or another instance starts over from the checkpoint
+            log.error("Error reading %s: %s", shard_id, str(e))
+            await asyncio.to_thread(self.leases.release, shard_id)
+
+
+def _list_shards():
+    """shardId -> the shardIds of its parents, for the shards of STREAM."""
+    shards, kwargs = {}, {"StreamName": STREAM}
+    while True:
+        resp = kinesis.list_shards(**kwargs)
+        for shard in resp.get("Shards", []):
+            shards[shard["ShardId"]] = [
+                shard[key]
+                for key in ("ParentShardId", "AdjacentParentShardId")
+                if shard.get(key)
+            ]
+        if not resp.get("NextToken"):
+            return shards
+        kwargs = {"NextToken": resp["NextToken"]}
+
+
+def _iterator(
+    shard_id, sequence, type="AFTER_SEQUENCE_NUMBER", initial=INITIAL_POSITION
+):
+    """Shard iterator at (or after) a sequence number, at initial without one."""
+    if sequence is None:
+        return kinesis.get_shard_iterator(
+            StreamName=STREAM, ShardId=shard_id, ShardIteratorType=initial
+        )["ShardIterator"]
+    return kinesis.get_shard_iterator(
+        StreamName=STREAM,
+        ShardId=shard_id,
+        ShardIteratorType=type,
+        StartingSequenceNumber=sequence,
+    )["ShardIterator"]
+
+
+def _event(shard_id, records):
+    """A page of GetRecords results as the Kinesis event of a Lambda."""
+    return {
+        "Records": [
+            {
+                "eventID": f"{shard_id}:{r['SequenceNumber']}",
+                "kinesis": {
+                    "sequenceNumber": r["SequenceNumber"],
+                    "partitionKey": r.get("PartitionKey"),
+                    "data": base64.b64encode(r["Data"]).decode(),
+                },
+            }
+            for r in records
+        ]
+    }
+
+
+async def main():
+    service = Service()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, service.stopping.set)
+    await service.run()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main())
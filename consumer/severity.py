@@ -0,0 +1,104 @@
+import logging
+import os
+import re
+
+import jsoncodec
+
+log = logging.getLogger()
+
+# Levels in increasing severity
+LEVELS = ("debug", "info", "warn", "error", "fatal")
+
+# Other names producers give levels
+ALIASES = {"warning": "warn", "err": "error", "critical": "fatal", "trace": "debug"}
+
+# Level of lines no rule matches
+DEFAULT_LEVEL = "info"
+
+# Classification rules per log type (see normalize.LOG_TYPES), as [level,
+# match] pairs where match is a list of words or a regex, both matched
+# case-insensitively; "*" applies to the types without rules of their own.
+# The level of a line is the one of the rule matching earliest in it, so
+# "runtime info: retrying after error" is info. SEVERITY_RULES, a JSON object
+# of the same shape, replaces the rules of the types it lists.
+WORDS = [
+    ["fatal", ["fatal", "panic", "critical", "segmentation fault", "core dumped"]],
+    [
+        "error",
+        [
+            "error",
+            "exception",
+            "traceback",
+            "failed",
+            "failure",
+            "out of memory",
+            "oomkilled",
+        ],
+    ],
+    ["warn", ["warn", "warning", "deprecated"]],
+    ["info", ["info"]],
+    ["debug", ["debug", "trace"]],
+]
+SEVERITY_RULES = {
+    "*": WORDS,
+    # glog lines start with the level letter, e.g. "E0501 12:00:00.123 ..."
+    "INFERENCE": [
+        ["fatal", r"^F\d{4} "],
+        ["error", r"^E\d{4} "],
+        ["warn", r"^W\d{4} "],
+        *WORDS,
+    ],
+    **jsoncodec.loads(os.environ.get("SEVERITY_RULES", "{}")),
+}
+
+
+class Classifier:
+    """
+    Rules of one log type compiled into a single alternation, so that a line
+    is scanned once whatever the number of rules. Word rules share a single
+    word-boundary check, which keeps the scan cheap at the positions where
+    no word starts.
+    """
+
+    def __init__(self, rules):
+        self.levels = {}
+        patterns, words = [], []
+        for level, match in rules:
+            if level not in LEVELS:
+                log.error("Ignoring severity rule for unknown level %s", level)
+                continue
+            group = "l%d" % len(self.levels)
+            self.levels[group] = level
+            if isinstance(match, list):
+                alternatives = "|".join(re.escape(word) for word in match)
+                words.append("(?P<%s>%s)" % (group, alternatives))
+            else:
+                patterns.append("(?P<%s>%s)" % (group, match))
+        if words:
+            patterns.append(r"\b(?:%s)\b" % "|".join(words))
+        self.pattern = (
+            re.compile("|".join(patterns), re.IGNORECASE) if patterns else None
+        )
+
+    def level(self, text):
+        match = self.pattern.search(text) if self.pattern is not None else None
+        return self.levels[match.lastgroup] if match else DEFAULT_LEVEL
+
+
+CLASSIFIERS = {
+    log_type: Classifier(rules) for log_type, rules in SEVERITY_RULES.items()
+}
+
+
+def classify(item, log_type):
+    """
+    Level of a normalized log item: the one the producer set when it is
+    known, else the one its log line is classified as.
+    """
+    level = item.get("level")
+    if isinstance(level, str):
+        level = ALIASES.get(level.lower(), level.lower())
+        if level in LEVELS:
+            return level
+    classifier = CLASSIFIERS.get(log_type) or CLASSIFIERS["*"]
+    return classifier.level(item.get("log", ""))
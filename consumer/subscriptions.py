@@ -0,0 +1,194 @@
+import logging
+import os
+from time import monotonic
+
+import jsoncodec
+
+log = logging.getLogger()
+
+# Subscriptions are read from the connections table (the rows with an
+# identifierId, identifierPrefixes or routeKeys attribute, see registrar) and
+# re-read at most every SUBSCRIPTIONS_RELOAD_SECONDS, as other consumer
+# instances do not see the control events of this one. A batch thus finds
+# its subscribers in memory instead of querying the table per identifier.
+SUBSCRIPTIONS_RELOAD_SECONDS = int(os.environ.get("SUBSCRIPTIONS_RELOAD_SECONDS", 60))
+
+# Record fields a route subscribes by, most significant first. A route is
+# stored as the JSON list of its values, where "*" matches any value and
+# may only be followed by more "*", e.g. ["model-1", "runtimeLogs"] or
+# ["model-1", "*"].
+ROUTE_DIMENSIONS = ("modelId", "logType")
+WILDCARD = "*"
+
+
+class _Node:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = None
+
+
+class PrefixTrie:
+    """
+    Connection items by the identifier prefixes they subscribe to ("runtime-"
+    for "runtime-*"). match walks an identifier once, collecting the
+    subscribers of each of its prefixes on the way, whatever the number of
+    prefixes subscribed to.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, prefix, cid, item):
+        node = self.root
+        for char in prefix:
+            node = node.children.setdefault(char, _Node())
+        if node.subscribers is None:
+            node.subscribers = {}
+        node.subscribers[cid] = item
+
+    def match(self, identifier):
+        """{connectionId: item} of the prefixes of identifier."""
+        matched = {}
+        node = self.root
+        for char in identifier:
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.subscribers:
+                matched.update(node.subscribers)
+        return matched
+
+
+class Subscriptions:
+    """
+    The identifier, prefix and route subscriptions of all connections.
+    Subscribing is rare and matching happens for every batch, so the
+    identifier index (identifier -> {connectionId: item}), the prefix trie
+    and the routing index (route -> {connectionId: item}) are rebuilt on the
+    first match after a change.
+    """
+
+    def __init__(self):
+        # connectionId -> (identifiers, prefixes, routes, item)
+        self.connections = {}
+        self.identifiers = None
+        self.trie = None
+        self.routes = None
+        self.checked = None
+
+    def drop(self, cid):
+        if self.connections.pop(cid, None) is not None:
+            self.identifiers = self.trie = self.routes = None
+
+    def match(self, identifier):
+        """{connectionId: item} of identifier and of its prefixes."""
+        if not self.connections:
+            return {}
+        if self.identifiers is None:
+            self.identifiers = {}
+            for cid, (identifiers, _, _, item) in self.connections.items():
+                for subscribed in identifiers:
+                    self.identifiers.setdefault(subscribed, {})[cid] = item
+        if self.trie is None:
+            self.trie = PrefixTrie()
+            for cid, (_, prefixes, _, item) in self.connections.items():
+                for prefix in prefixes:
+                    self.trie.add(prefix, cid, item)
+        matched = self.trie.match(identifier)
+        matched.update(self.identifiers.get(identifier, {}))
+        return matched
+
+    def route(self, values):
+        """
+        {connectionId: item} of the routes matching the route values of a
+        record (see route_values), one lookup per dimension.
+        """
+        if not self.connections:
+            return {}
+        if self.routes is None:
+            self.routes = {}
+            for cid, (_, _, routes, item) in self.connections.items():
+                for route in routes:
+                    self.routes.setdefault(route, {})[cid] = item
+        matched = {}
+        for key in route_keys(values):
+            matched.update(self.routes.get(key, {}))
+        return matched
+
+    def refresh(self, ddb, table, force=False):
+        """
+        Re-read the subscriptions from the table, at most every
+        SUBSCRIPTIONS_RELOAD_SECONDS unless forced. A forced refresh (after
+        a control event of this instance) reads consistently, so that it sees
+        the subscription just written. The current ones stay in force when
+        they cannot be read.
+        """
+        if (
+            not force
+            and self.checked is not None
+            and monotonic() - self.checked < SUBSCRIPTIONS_RELOAD_SECONDS
+        ):
+            return
+        self.checked = monotonic()
+        try:
+            connections = {}
+            kwargs = {
+                "TableName": table,
+                "FilterExpression": "attribute_exists(identifierId)"
+                " OR attribute_exists(identifierPrefixes)"
+                " OR attribute_exists(routeKeys)",
+            }
+            if force:
+                kwargs["ConsistentRead"] = True
+            while True:
+                resp = ddb.scan(**kwargs)
+                for item in resp.get("Items", []):
+                    cid = item["PK"]["S"].split("#", 1)[1]
+                    identifiers = [
+                        i["S"] for i in item.get("identifierId", {}).get("L", [])
+                    ]
+                    prefixes = [
+                        p["S"] for p in item.get("identifierPrefixes", {}).get("L", [])
+                    ]
+                    routes = [
+                        tuple(jsoncodec.loads(r["S"]))
+                        for r in item.get("routeKeys", {}).get("L", [])
+                    ]
+                    connections[cid] = (identifiers, prefixes, routes, item)
+                if "LastEvaluatedKey" not in resp:
+                    break
+                kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+        except Exception as e:
+            log.error("Could not reload subscriptions: %s", str(e))
+            return
+        self.connections = connections
+        self.identifiers = self.trie = self.routes = None
+
+
+def route_values(record):
+    """
+    The values of a record for ROUTE_DIMENSIONS, None from the first one it
+    has no string for on. None when it has none.
+    """
+    values = []
+    for dimension in ROUTE_DIMENSIONS:
+        value = record.get(dimension)
+        if not isinstance(value, str) or not value or value == WILDCARD:
+            break
+        values.append(value)
+    if not values:
+        return None
+    return tuple(values) + (None,) * (len(ROUTE_DIMENSIONS) - len(values))
+
+
+def route_keys(values):
+    """
+    The routes matching the route values of a record, most general first:
+    ("m", "*") then ("m", "runtimeLogs") for ("m", "runtimeLogs").
+    """
+    for i, value in enumerate(values):
+        if value is None:
+            break
+        yield values[: i + 1] + (WILDCARD,) * (len(values) - i - 1)
@@ -15,6 +15,9 @@ LAMBDA_AUTH="WebsocketAuthorizerLambda"
 LAMBDA_CONSUMER="WebsocketConsumerLambda"
 LAMBDA_REGISTRAR="WebsocketRegistrarLambda"
 JWT_SECRET="my-demo-secret"   # ← replace with your actual secret
+ZSTD_FRAMES="false"           # ← "true" to bundle zstandard and offer zstd frames
+MSGPACK_FRAMES="false"        # ← "true" to bundle msgpack and offer MessagePack frames
+REGEX_FILTERS="false"         # ← "true" to bundle RE2 and accept regex log filters
 
 ###
 ### 1) Create Kinesis stream
@@ -79,10 +82,13 @@ cat > /tmp/socket-policy.json <<EOF
     {
       "Effect":"Allow",
       "Action":[
+        "dynamodb:GetItem",
         "dynamodb:PutItem",
         "dynamodb:UpdateItem",
         "dynamodb:DeleteItem",
-        "dynamodb:Query"
+        "dynamodb:BatchWriteItem",
+        "dynamodb:Query",
+        "dynamodb:Scan"
       ],
       "Resource":[
         "arn:aws:dynamodb:$REGION:$ACCOUNT:table/$TABLE_NAME",
@@ -120,6 +126,11 @@ aws iam put-role-policy \
 ###
 ### 4) Package & create Lambdas
 ###
+# every Lambda bundles the shared modules (and orjson, when vendored next to them)
+echo "→ Packaging Authorizer Lambda"
+(cd authorizer/deployment-package && zip -qr ../../authorizer.zip . -x deployment-package.zip)
+zip -qj authorizer.zip authorizer/authorizer.py shared/*.py
+
 echo "→ Creating Authorizer Lambda: $LAMBDA_AUTH"
 aws lambda create-function \
   --function-name "$LAMBDA_AUTH" \
@@ -130,6 +141,21 @@ aws lambda create-function \
   --timeout 10 \
   --environment Variables="{JWT_SECRET=$JWT_SECRET}"
 
+# the consumer is split over several modules, bundle all of them
+echo "→ Packaging Consumer Lambda"
+(cd consumer && zip -q ../consumer.zip *.py)
+zip -qj consumer.zip shared/*.py
+CONSUMER_DEPS=()
+[ "$ZSTD_FRAMES" = "true" ] && CONSUMER_DEPS+=(zstandard)
+[ "$MSGPACK_FRAMES" = "true" ] && CONSUMER_DEPS+=(msgpack)
+[ "$REGEX_FILTERS" = "true" ] && CONSUMER_DEPS+=(google-re2)
+if [ ${#CONSUMER_DEPS[@]} -gt 0 ]; then
+  rm -rf /tmp/consumer-deps
+  pip install -q "${CONSUMER_DEPS[@]}" --target /tmp/consumer-deps \
+    --platform manylinux2014_x86_64 --python-version 3.12 --only-binary=:all:
+  (cd /tmp/consumer-deps && zip -qr "$OLDPWD/consumer.zip" .)
+fi
+
 echo "→ Creating Consumer Lambda: $LAMBDA_CONSUMER"
 aws lambda create-function \
   --function-name "$LAMBDA_CONSUMER" \
@@ -139,6 +165,16 @@ aws lambda create-function \
   --zip-file fileb://consumer.zip \
   --timeout 300
 
+echo "→ Packaging Registrar Lambda"
+zip -qj registrar.zip registrar/registrar.py shared/*.py
+# regex filters are validated with the same engine the consumer runs them with
+if [ "$REGEX_FILTERS" = "true" ]; then
+  rm -rf /tmp/registrar-deps
+  pip install -q google-re2 --target /tmp/registrar-deps \
+    --platform manylinux2014_x86_64 --python-version 3.12 --only-binary=:all:
+  (cd /tmp/registrar-deps && zip -qr "$OLDPWD/registrar.zip" .)
+fi
+
 echo "→ Creating Registrar Lambda: $LAMBDA_REGISTRAR"
 aws lambda create-function \
   --function-name "$LAMBDA_REGISTRAR" \
@@ -147,7 +183,7 @@ aws lambda create-function \
   --handler registrar.handler \
   --zip-file fileb://registrar.zip \
   --timeout 60 \
-  --environment Variables="{TABLE=$TABLE_NAME,CONSUMER_ARN=arn:aws:lambda:$REGION:$ACCOUNT:function:$LAMBDA_CONSUMER}"
+  --environment Variables="{TABLE=$TABLE_NAME,CONSUMER_ARN=arn:aws:lambda:$REGION:$ACCOUNT:function:$LAMBDA_CONSUMER,ZSTD_FRAMES=$ZSTD_FRAMES,MSGPACK_FRAMES=$MSGPACK_FRAMES,REGEX_FILTERS=$REGEX_FILTERS}"
 
 ###
 ### 5) Create the WebSocket API
@@ -252,6 +288,9 @@ aws lambda create-event-source-mapping \
   --function-name "$LAMBDA_CONSUMER" \
   --batch-size 100 \
   --starting-position TRIM_HORIZON \
+  --function-response-types ReportBatchItemFailures \
+  --bisect-batch-on-function-error \
+  --maximum-retry-attempts 10 \
   --event-source-arn arn:aws:kinesis:$REGION:$ACCOUNT:stream/$STREAM_NAME
 
 echo "✅ All infra created successfully!"  
@@ -1,7 +1,16 @@
 import boto3
-import json
 import os
 import logging
+import re
+import uuid
+from datetime import datetime, timezone
+
+import jsoncodec
+
+try:
+    import re2
+except ImportError:  # optional, regex filters are refused without it
+    re2 = None
 
 # Initialize clients and config
 ddb = boto3.client("dynamodb")
@@ -9,6 +18,52 @@ lambdacli = boto3.client("lambda")
 TABLE = os.environ["TABLE"]
 CONSUMER_ARN = os.environ.get("CONSUMER_ARN")
 
+# Frame compression codecs a client may request in streamLogs. zstd only
+# when the consumer is deployed with zstandard (ZSTD_FRAMES=true, see
+# infra.sh), as it sends plain frames otherwise.
+CODECS = ("deflate", "gzip")
+if os.environ.get("ZSTD_FRAMES") == "true":
+    CODECS += ("zstd",)
+
+# Frame formats a client may request in streamLogs, JSON arrays by default
+FORMATS = ("columnar",)
+
+# Frame encodings a client may request in streamLogs, JSON by default.
+# msgpack only when the consumer is deployed with it (MSGPACK_FRAMES=true,
+# see infra.sh), as it sends JSON frames otherwise.
+ENCODINGS = ()
+if os.environ.get("MSGPACK_FRAMES") == "true":
+    ENCODINGS += ("msgpack",)
+
+# identifierId entries ending in "*" subscribe to every identifier starting
+# with the rest, e.g. "runtime-*" or "workspace-1/model-2/*"
+MAX_IDENTIFIER_PREFIXES = int(os.environ.get("MAX_IDENTIFIER_PREFIXES", 16))
+
+# Routes a client may subscribe to in streamLogs besides identifiers, e.g.
+# {"modelId": "m1", "logType": "runtimeLogs"} or {"modelId": "m1"} for all
+# its log types. Fields are in routing order (see consumer subscriptions),
+# a missing one matching any value; only trailing fields may be missing.
+ROUTE_DIMENSIONS = ("modelId", "logType")
+MAX_ROUTES = int(os.environ.get("MAX_ROUTES", 16))
+
+# Log filter a client may set in streamLogs: which streams, the minimum
+# level, a substring and a regex the line must contain, and a time floor
+# (ISO-8601 or epoch milliseconds). Regexes are only accepted when the
+# consumer is deployed with RE2 (REGEX_FILTERS=true, see infra.sh, which
+# bundles it here too), and only when RE2 compiles them: no backreferences,
+# lookarounds nor Python-only syntax such as \Z.
+FILTER_STREAMS = ("stdout", "stderr")
+FILTER_LEVELS = ("debug", "info", "warn", "error", "fatal")
+MAX_FILTER_PATTERN = 256
+REGEX_FILTERS = os.environ.get("REGEX_FILTERS") == "true"
+NOT_RE2 = re.compile(r"\\[1-9]|\(\?(?:=|!|<=|<!|P=)")
+
+# Caps of the line budget a client may ask for in streamLogs
+# ({"rateLimit": {"linesPerSecond": ..., "burst": ...}}); higher requests are
+# lowered to them
+MAX_LINE_RATE = float(os.environ.get("MAX_LINE_RATE", 1000))
+MAX_LINE_BURST = int(os.environ.get("MAX_LINE_BURST", 5000))
+
 # Logger setup
 log = logging.getLogger()
 log.setLevel(logging.INFO)
@@ -28,31 +83,136 @@ def handler(event, context):
 
     # 2) streamLogs: record the desired identifierId and notify consumer for back-fill
     if route == "streamLogs":
-        body = json.loads(event.get("body", "{}"))
-        identifiers = body.get("identifierId")
-        if not identifiers:
-            return {"statusCode": 400, "body": "identifierId required"}
+        body = jsoncodec.loads(event.get("body") or "{}")
+        identifiers = body.get("identifierId") or []
+        if not identifiers and not body.get("routes"):
+            return {"statusCode": 400, "body": "identifierId or routes required"}
 
         # Ensure identifiers is always a list
         if not isinstance(identifiers, list):
             identifiers = [identifiers]
 
+        try:
+            exact, prefixes = _split_identifiers(identifiers)
+        except ValueError as e:
+            return {"statusCode": 400, "body": f"invalid identifierId: {e}"}
+
+        try:
+            routes = _routes(body.get("routes"))
+        except ValueError as e:
+            return {"statusCode": 400, "body": f"invalid routes: {e}"}
+
+        # Optional frame compression, plain JSON when not requested
+        codec = body.get("compression")
+        if codec is not None and codec not in CODECS:
+            return {"statusCode": 400, "body": "unsupported compression"}
+
+        fmt = body.get("format")
+        if fmt is not None and fmt not in FORMATS:
+            return {"statusCode": 400, "body": "unsupported format"}
+
+        encoding = body.get("encoding")
+        if encoding is not None and encoding not in ENCODINGS:
+            return {"statusCode": 400, "body": "unsupported encoding"}
+
+        try:
+            spec = _filter_spec(body.get("filter"))
+        except ValueError as e:
+            return {"statusCode": 400, "body": f"invalid filter: {e}"}
+        spec_text = jsoncodec.dumps(spec).decode() if spec else None
+
+        try:
+            rate_limit = _rate_limit(body.get("rateLimit"))
+        except ValueError as e:
+            return {"statusCode": 400, "body": f"invalid rateLimit: {e}"}
+
         # Store as a string list in DynamoDB
-        identifier_items = [{"S": identifier} for identifier in identifiers]
+        identifier_items = [{"S": identifier} for identifier in exact]
 
+        # A new id per subscription, which a back-fill checks before it
+        # carries on (see consumer), so that it stops after a stopStream or
+        # another streamLogs
+        subscription = uuid.uuid4().hex
+        update = "SET identifierId = :ids, subscriptionId = :subscription"
+        values = {
+            ":ids": {"L": identifier_items},
+            ":subscription": {"S": subscription},
+        }
+        removed = []
         # Use the first identifier as the GSI key (required to be a string)
-        first_identifier = identifiers[0] if identifiers else ""
+        if exact:
+            update += ", identifierIdGSI = :first_id"
+            values[":first_id"] = {"S": exact[0]}
+        else:
+            removed.append("identifierIdGSI")
+        # The consumer loads the subscriptions from the rows having them
+        # (see consumer subscriptions)
+        if prefixes:
+            update += ", identifierPrefixes = :prefixes"
+            values[":prefixes"] = {"L": [{"S": prefix} for prefix in prefixes]}
+        else:
+            removed.append("identifierPrefixes")
+        if routes:
+            update += ", routeKeys = :routes"
+            values[":routes"] = {
+                "L": [{"S": jsoncodec.dumps(route).decode()} for route in routes]
+            }
+        else:
+            removed.append("routeKeys")
+        # Keep the frame options on the connection row so the consumer needs
+        # no lookup at send time
+        if codec:
+            update += ", codec = :codec"
+            values[":codec"] = {"S": codec}
+        else:
+            removed.append("codec")
+        if fmt:
+            update += ", frameFormat = :fmt"
+            values[":fmt"] = {"S": fmt}
+        else:
+            removed.append("frameFormat")
+        if encoding:
+            update += ", frameEncoding = :encoding"
+            values[":encoding"] = {"S": encoding}
+        else:
+            removed.append("frameEncoding")
+        # Stored in canonical form, so that the consumer evaluates identical
+        # filters once
+        if spec_text:
+            update += ", filterSpec = :filter"
+            values[":filter"] = {"S": spec_text}
+        else:
+            removed.append("filterSpec")
+        for attribute, field in (
+            ("lineRate", "linesPerSecond"),
+            ("lineBurst", "burst"),
+        ):
+            if rate_limit and field in rate_limit:
+                update += f", {attribute} = :{attribute}"
+                values[f":{attribute}"] = {"N": str(rate_limit[field])}
+            else:
+                removed.append(attribute)
+        # A new subscription replays history: forget what the consumer
+        # delivered of the previous one
+        removed.append("deliveryMarks")
+        if removed:
+            update += " REMOVE " + ", ".join(removed)
 
         ddb.update_item(
             TableName=TABLE,
             Key=pk,
-            UpdateExpression="SET identifierId = :ids, identifierIdGSI = :first_id",
-            ExpressionAttributeValues={
-                ":ids": {"L": identifier_items},
-                ":first_id": {"S": first_identifier},
-            },
+            UpdateExpression=update,
+            ExpressionAttributeValues=values,
+        )
+        log.info(
+            "Subscribed: %s → %s (compression %s, format %s, encoding %s, filter %s)",
+            cid,
+            identifiers,
+            codec,
+            fmt,
+            encoding,
+            spec_text,
         )
-        log.info("Subscribed: %s → %s", cid, identifiers)
 
         # Notify the Consumer Lambda for back-fill
         if CONSUMER_ARN:
@@ -60,17 +220,35 @@ def handler(event, context):
                 "type": "control",
                 "action": "set",
                 "connectionId": cid,
-                "identifierId": identifiers,
+                "identifierId": exact,
+                "identifierPrefix": prefixes,
+                "routes": routes,
+                "codec": codec,
+                "format": fmt,
+                "encoding": encoding,
+                "filter": spec_text,
+                "subscriptionId": subscription,
             }
             lambdacli.invoke(
                 FunctionName=CONSUMER_ARN,
                 InvocationType="Event",
-                Payload=json.dumps(payload).encode(),
+                Payload=jsoncodec.dumps(payload),
             )
 
         return {
             "statusCode": 200,
-            "body": json.dumps({"ack": "OK", "identifierId": identifiers}),
+            "body": jsoncodec.dumps(
+                {
+                    "ack": "OK",
+                    "identifierId": identifiers,
+                    "routes": routes,
+                    "compression": codec,
+                    "format": fmt,
+                    "encoding": encoding,
+                    "filter": spec,
+                    "rateLimit": rate_limit,
+                }
+            ).decode(),
         }
 
     # 3) stopStream: clear the subscription and notify consumer
@@ -78,7 +256,7 @@ def handler(event, context):
         ddb.update_item(
             TableName=TABLE,
             Key=pk,
-            UpdateExpression="REMOVE identifierId, identifierIdGSI",
+            UpdateExpression="REMOVE identifierId, identifierIdGSI, identifierPrefixes, routeKeys, codec, frameFormat, frameEncoding, filterSpec, lineRate, lineBurst, subscriptionId, deliveryMarks",
         )
         log.info("Unsubscribed: %s", cid)
 
@@ -87,10 +265,10 @@ def handler(event, context):
             lambdacli.invoke(
                 FunctionName=CONSUMER_ARN,
                 InvocationType="Event",
-                Payload=json.dumps(payload).encode(),
+                Payload=jsoncodec.dumps(payload),
             )
 
-        return {"statusCode": 200, "body": json.dumps({"ack": "stopped"})}
+        return {"statusCode": 200, "body": jsoncodec.dumps({"ack": "stopped"}).decode()}
 
     # 4) $disconnect: clean up the connection entry and notify consumer
     if route == "$disconnect":
@@ -102,7 +280,7 @@ def handler(event, context):
             lambdacli.invoke(
                 FunctionName=CONSUMER_ARN,
                 InvocationType="Event",
-                Payload=json.dumps(payload).encode(),
+                Payload=jsoncodec.dumps(payload),
             )
 
         return {"statusCode": 200, "body": "disconnected"}
@@ -110,3 +288,161 @@ def handler(event, context):
     # Unknown route
     log.warning("Unknown route: %s", route)
     return {"statusCode": 400, "body": "unknown route"}
+
+
+def _split_identifiers(identifiers):
+    """
+    Split the identifierId list of a streamLogs request into exact
+    identifiers and prefixes (the "prefix*" entries, without the "*").
+    Raises ValueError when an entry is invalid.
+    """
+    exact, prefixes = [], []
+    for identifier in identifiers:
+        if not isinstance(identifier, str) or not identifier:
+            raise ValueError("entries must be non-empty strings")
+        if "*" not in identifier:
+            exact.append(identifier)
+            continue
+        prefix = identifier[:-1]
+        if not identifier.endswith("*") or "*" in prefix:
+            raise ValueError("* is only allowed at the end")
+        if not prefix:
+            raise ValueError("* needs a prefix")
+        prefixes.append(prefix)
+    if len(prefixes) > MAX_IDENTIFIER_PREFIXES:
+        raise ValueError(f"over {MAX_IDENTIFIER_PREFIXES} patterns")
+    return exact, prefixes
+
+
+def _routes(routes):
+    """
+    Validate the routes of a streamLogs request and return them as lists of
+    ROUTE_DIMENSIONS values, "*" standing for the missing ones. Raises
+    ValueError when they are invalid.
+    """
+    if routes is None:
+        return []
+    if not isinstance(routes, list):
+        raise ValueError("must be a list")
+    if len(routes) > MAX_ROUTES:
+        raise ValueError(f"over {MAX_ROUTES} routes")
+    canonical = []
+    for route in routes:
+        if not isinstance(route, dict) or set(route) - set(ROUTE_DIMENSIONS):
+            raise ValueError("routes must be objects of " + ", ".join(ROUTE_DIMENSIONS))
+        values = []
+        for dimension in ROUTE_DIMENSIONS:
+            value = route.get(dimension)
+            if value is None:
+                break
+            if not isinstance(value, str) or not value or value == "*":
+                raise ValueError(f"{dimension} must be a non-empty string")
+            values.append(value)
+        if len(values) < len(route):
+            raise ValueError("only the last fields of a route may be left out")
+        if not values:
+            raise ValueError(f"{ROUTE_DIMENSIONS[0]} required")
+        values += ["*"] * (len(ROUTE_DIMENSIONS) - len(values))
+        if values not in canonical:
+            canonical.append(values)
+    return canonical
+
+
+def _filter_spec(spec):
+    """
+    Validate the filter of a streamLogs request and return it in canonical
+    form (fixed key order, sorted streams, time floor in epoch milliseconds),
+    None when there is no filter. Raises ValueError when it is invalid.
+    """
+    if spec is None:
+        return None
+    if not isinstance(spec, dict):
+        raise ValueError("must be an object")
+    unknown = set(spec) - {"stream", "level", "contains", "regex", "since"}
+    if unknown:
+        raise ValueError("unknown fields " + ", ".join(sorted(unknown)))
+
+    canonical = {}
+    streams = spec.get("stream")
+    if streams is not None:
+        streams = [streams] if isinstance(streams, str) else streams
+        if (
+            not isinstance(streams, list)
+            or not streams
+            or any(stream not in FILTER_STREAMS for stream in streams)
+        ):
+            raise ValueError("stream must be one or more of stdout, stderr")
+        canonical["stream"] = sorted(set(streams))
+
+    level = spec.get("level")
+    if level is not None:
+        if level not in FILTER_LEVELS:
+            raise ValueError("level must be one of " + ", ".join(FILTER_LEVELS))
+        canonical["level"] = level
+
+    for field in ("contains", "regex"):
+        value = spec.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str) or not value:
+            raise ValueError(f"{field} must be a non-empty string")
+        if len(value) > MAX_FILTER_PATTERN:
+            raise ValueError(f"{field} over {MAX_FILTER_PATTERN} characters")
+        if field == "regex":
+            if not REGEX_FILTERS or re2 is None:
+                raise ValueError("regex filters are not enabled")
+            if NOT_RE2.search(value):
+                raise ValueError(
+                    "regex backreferences and lookarounds are not supported"
+                )
+            try:
+                re2.compile(value)
+            except re2.error as e:
+                raise ValueError(f"regex does not compile: {e}")
+        canonical[field] = value
+
+    since = spec.get("since")
+    if since is not None:
+        canonical["since"] = _epoch_ms(since)
+    return canonical or None
+
+
+def _epoch_ms(value):
+    """Parse a time floor, given as ISO-8601 (UTC when no offset) or epoch ms."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+        else:
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+            return round(parsed.timestamp() * 1000)
+    raise ValueError("since must be an ISO-8601 time or epoch milliseconds")
+
+
+def _rate_limit(limit):
+    """
+    Validate the line budget of a streamLogs request, lowering it to the
+    server caps. Raises ValueError when it is invalid.
+    """
+    if limit is None:
+        return None
+    if not isinstance(limit, dict) or set(limit) - {"linesPerSecond", "burst"}:
+        raise ValueError("must be an object with linesPerSecond and/or burst")
+    capped = {}
+    for field, cap, kind in (
+        ("linesPerSecond", MAX_LINE_RATE, float),
+        ("burst", MAX_LINE_BURST, int),
+    ):
+        value = limit.get(field)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"{field} must be a positive number")
+        if kind is int and value != int(value):
+            raise ValueError(f"{field} must be a whole number")
+        capped[field] = kind(min(value, cap))
+    return capped or None
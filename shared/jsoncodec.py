@@ -0,0 +1,40 @@
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # optional, only used when bundled with the Lambda
+    orjson = None
+
+# orjson parses integers outside the 64-bit range into floats, losing digits
+# (a traceId of 18446744073709551616 would be sent as 1.8446744073709552e19).
+# Documents with a run of this many digits are parsed by json instead, which
+# keeps them exact.
+_LONG_DIGITS = re.compile(r"\d{19,}")
+_LONG_DIGITS_BYTES = re.compile(rb"\d{19,}")
+
+
+def loads(data):
+    """Parse JSON from bytes or str, integers of any size kept exact."""
+    if orjson is not None:
+        long_digits = _LONG_DIGITS if isinstance(data, str) else _LONG_DIGITS_BYTES
+        if long_digits.search(data) is None:
+            return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value) -> bytes:
+    """
+    Serialize to compact UTF-8 JSON bytes: no whitespace and non-ASCII
+    characters left unescaped. Values orjson refuses (integers outside the
+    64-bit range, non-str keys) are serialized by json instead, so both
+    backends accept the same values. Their output still differs for floats:
+    orjson writes NaN and infinities as null where json writes NaN and
+    Infinity, and exponents as 1e19 where json writes 1e+19.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()